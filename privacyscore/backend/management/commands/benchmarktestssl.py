@@ -0,0 +1,94 @@
+# Copyright (C) 2018 PrivacyScore Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from time import perf_counter
+
+from django.core.management import BaseCommand
+
+from privacyscore.backend.models import RawScanResult
+from privacyscore.scanner.test_suites import AVAILABLE_TEST_SUITES, \
+    TEST_PARAMETERS
+from privacyscore.test_suites.testssl.common import TestsslResult, \
+    load_testssl_json
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the processing of stored testssl results.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--test', choices=['testssl_https', 'testssl_mx'],
+            default='testssl_https')
+        parser.add_argument(
+            '--count', '-c', type=int, default=100,
+            help='Number of the most recent raw results to use')
+        parser.add_argument(
+            '--repeat', '-r', type=int, default=5,
+            help='Number of passes over the raw results')
+
+    def handle(self, *args, **options):
+        test = options['test']
+        test_suite = AVAILABLE_TEST_SUITES[test]
+        parameters = TEST_PARAMETERS[test]
+
+        raw_results = RawScanResult.objects.filter(
+            test=test, identifier='jsonresult').order_by('-id')[:options['count']]
+        raw_data = []
+        for raw_result in raw_results:
+            try:
+                data = bytes(raw_result.retrieve())
+            except FileNotFoundError:
+                continue
+            if data:
+                raw_data.append(data)
+        if not raw_data:
+            self.stdout.write('No raw results of {} found'.format(test))
+            return
+
+        size = sum(len(data) for data in raw_data)
+        self.stdout.write('{} raw results, {:.1f} KiB on average'.format(
+            len(raw_data), size / len(raw_data) / 1024))
+
+        failed = 0
+        timings = {'decode': 0, 'index': 0, 'process': 0}
+        for _ in range(options['repeat']):
+            for data in raw_data:
+                start = perf_counter()
+                try:
+                    decoded = load_testssl_json(data)
+                except ValueError:
+                    failed += 1
+                    continue
+                decoded_at = perf_counter()
+                if decoded.get('scanResult'):
+                    TestsslResult(decoded)
+                indexed_at = perf_counter()
+                try:
+                    test_suite.process_test_data(
+                        {'jsonresult': {'data': data}}, {}, **parameters)
+                except Exception:
+                    failed += 1
+                end = perf_counter()
+                timings['decode'] += decoded_at - start
+                timings['index'] += indexed_at - decoded_at
+                timings['process'] += end - indexed_at
+
+        # process is the complete processing by the test suite, including
+        # decoding and indexing
+        runs = len(raw_data) * options['repeat']
+        for phase in ('decode', 'index', 'process'):
+            self.stdout.write('{:8} {:8.3f} ms per result'.format(
+                phase, timings[phase] / runs * 1000))
+        if failed:
+            self.stdout.write('{} of {} runs failed'.format(failed, runs))
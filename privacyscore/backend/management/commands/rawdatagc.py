@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
+from time import time
 
 from django.conf import settings
 from django.core.management import BaseCommand
@@ -37,11 +38,14 @@ class Command(BaseCommand):
         known_files = [v['file_name'] for v in RawScanResult.objects.filter(
             file_name__isnull=False).values('file_name')]
 
+        # files of running scans may not be known to the db yet
+        min_mtime = time() - settings.SCAN_TOTAL_TIMEOUT.total_seconds()
+
         deleted = 0
         for file in os.listdir(settings.RAW_DATA_DIR):
-            if file not in known_files:
-                os.remove(os.path.join(
-                    settings.RAW_DATA_DIR, file))
+            path = os.path.join(settings.RAW_DATA_DIR, file)
+            if file not in known_files and os.path.getmtime(path) < min_mtime:
+                os.remove(path)
                 deleted += 1
         print('Deleted {} files from file system'.format(deleted))
 
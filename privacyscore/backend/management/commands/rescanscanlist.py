@@ -13,12 +13,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+from math import ceil
 from time import sleep
+from urllib.parse import urlparse
 
+from django.conf import settings
 from django.core.management import BaseCommand
 from django.utils import timezone
 
-from privacyscore.backend.models import Site, ScanList
+from privacyscore.backend.models import Scan, Site, ScanList
+from privacyscore.scanner.tasks import dispatch_queued_scans, \
+    prefetch_testssl
+from privacyscore.scanner.test_suites import TEST_PARAMETERS
+from privacyscore.test_suites.testssl.common import get_https_hostname
 from privacyscore.utils import normalize_url
 
 
@@ -28,14 +35,29 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('scan_list_id')
         parser.add_argument('-s', '--sleep-between-scans', type=float, default=0)
+        parser.add_argument(
+            '--prefetch-testssl', action='store_true',
+            help='Test the https servers of all sites with testssl in '
+                 'batches before scanning them.')
 
     def handle(self, *args, **options):
         scan_list = ScanList.objects.get(id=options['scan_list_id'])
         sites = scan_list.sites.all()
 
+        if options['prefetch_testssl']:
+            hostnames = sorted(self._get_https_hostnames(scan_list))
+            cache_timeout = self._get_prefetch_timeout(len(sites))
+            batch_size = settings.SCAN_TESTSSL_BATCH_SIZE
+            for i in range(0, len(hostnames), batch_size):
+                prefetch_testssl.delay(
+                    hostnames[i:i + batch_size], cache_timeout=cache_timeout)
+            self.stdout.write(
+                'Prefetching testssl results of {} hosts for {} seconds'.format(
+                    len(hostnames), cache_timeout))
+
         scan_count = 0
         for site in sites:
-            status_code = site.scan()
+            status_code = site.scan(scan_list=scan_list, dispatch=False)
             if status_code == Site.SCAN_COOLDOWN:
                 self.stdout.write(
                     'Rate limiting -- Not scanning site {}'.format(site))
@@ -48,8 +70,49 @@ class Command(BaseCommand):
             self.stdout.write('Scanning site {}'.format(
                 site))
             if options['sleep_between_scans']:
+                # the scan is not meant to wait for the following ones
+                dispatch_queued_scans.delay()
                 self.stdout.write('Sleeping {}'.format(options['sleep_between_scans']))
                 sleep(options['sleep_between_scans'])
 
+        if scan_count:
+            dispatch_queued_scans.delay()
+
         self.stdout.write('read {} sites, scanned {}'.format(
             len(sites), scan_count))
+
+    def _get_https_hostnames(self, scan_list: ScanList) -> set:
+        """
+        Get the hostnames testssl_https will test, as far as they are known
+        from the last scans of the sites.
+        """
+        hostnames = set()
+        for site in scan_list.sites.annotate_most_recent_scan_result():
+            if site.last_scan__result:
+                hostname = get_https_hostname(
+                    site.url, site.last_scan__result)
+            else:
+                # not scanned yet; the site may redirect to https
+                hostname = urlparse(site.url).hostname
+            if hostname:
+                hostnames.add(hostname)
+        return hostnames
+
+    def _get_prefetch_timeout(self, site_count: int) -> int:
+        """
+        Get the time for which prefetched results are cached: the cache
+        timeout of testssl_https plus the time the queued scans are expected
+        to wait for a slot, estimated from the duration of recent scans.
+        """
+        durations = [
+            (end - start).total_seconds()
+            for start, end in Scan.objects.filter(
+                start__isnull=False, end__isnull=False).order_by(
+                '-end').values_list('start', 'end')[:100]]
+        duration = sum(durations) / len(durations) if durations else \
+            settings.SCAN_SUITE_TIMEOUT_SECONDS
+        queued = Scan.objects.filter(queued=True).count() + site_count
+        slots = max(min(
+            settings.SCAN_MAX_RUNNING, settings.SCAN_LIST_MAX_RUNNING), 1)
+        return int(TEST_PARAMETERS['testssl_https'].get('cache_timeout', 0) +
+                   ceil(queued / slots) * duration)
@@ -19,6 +19,7 @@ from django.core.management import BaseCommand
 from django.utils import timezone
 
 from privacyscore.backend.models import Site, ScanList
+from privacyscore.scanner.tasks import dispatch_queued_scans
 from privacyscore.utils import normalize_url
 
 
@@ -67,6 +68,7 @@ class Command(BaseCommand):
                     site = Site.objects.get_or_create(url=url)[0]
                     sites.append(site)
 
+        scan_list = None
         if options['create_list_name']:
             list_name = options['create_list_name']
             self.stdout.write('Creating ScanList {}'.format(list_name))
@@ -76,7 +78,7 @@ class Command(BaseCommand):
 
         scan_count = 0
         for site in sites:
-            status_code = site.scan()
+            status_code = site.scan(scan_list=scan_list, dispatch=False)
             if status_code == Site.SCAN_COOLDOWN:
                 self.stdout.write(
                     'Rate limiting -- Not scanning site {}'.format(site))
@@ -97,8 +99,13 @@ class Command(BaseCommand):
                     self.stdout.write("Invalid new sleep time, using old value: %s" % str(sleep_interval))
 
             if sleep_interval > 0:
+                # the scan is not meant to wait for the following ones
+                dispatch_queued_scans.delay()
                 self.stdout.write('Sleeping {}'.format(sleep_interval))
                 sleep(sleep_interval)
 
+        if scan_count:
+            dispatch_queued_scans.delay()
+
         self.stdout.write('read {} sites, scanned {}'.format(
             len(sites), scan_count))
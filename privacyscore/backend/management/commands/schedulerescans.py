@@ -44,8 +44,7 @@ class Command(BaseCommand):
         """Schedules a new scan regularly."""
         while True:
             # see if there are sites that have not been scanned yet
-            sites = Site.objects.annotate_most_recent_scan_start() \
-                .filter(last_scan__start__isnull=True, last_scan__isnull=True)
+            sites = Site.objects.filter(scans__isnull=True)
             if not sites:
                 self.stdout.write('There are no unscanned sites.')
                 self.stdout.flush()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2018-02-05 14:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0019_blacklistentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanTestRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('test', models.CharField(max_length=80)),
+                ('finished', models.BooleanField(default=False)),
+                ('scan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='test_runs', to='backend.Scan')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='scantestrun',
+            unique_together=set([('scan', 'test')]),
+        ),
+    ]
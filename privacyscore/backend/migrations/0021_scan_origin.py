@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2018-02-12 11:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0020_scantestrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scan',
+            name='origin',
+            field=models.CharField(choices=[('INT', 'Interactive'), ('LST', 'List'), ('BGR', 'Background')], default='BGR', max_length=3),
+        ),
+    ]
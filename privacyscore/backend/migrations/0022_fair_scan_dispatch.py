@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2018-02-14 16:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0021_scan_origin'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scan',
+            name='queued',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='scan',
+            name='scan_list',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='backend.ScanList'),
+        ),
+        migrations.AlterField(
+            model_name='scan',
+            name='start',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='scanlist',
+            name='scan_weight',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
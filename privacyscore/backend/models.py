@@ -3,9 +3,10 @@ import os
 import random
 import string
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from tldextract import extract
-from typing import Iterable, Tuple, Union
+from hashlib import sha256
+from typing import Iterable, List, Tuple, Union
 from uuid import uuid4
 
 from django.conf import settings
@@ -18,6 +19,7 @@ from django.utils import timezone
 from django.utils.functional import cached_property
 
 from privacyscore.evaluation.site_evaluation import SiteEvaluation
+from privacyscore.utils import extract_domain
 
 
 def generate_random_token() -> str:
@@ -86,6 +88,9 @@ class ScanList(models.Model):
 
     created = models.DateTimeField(default=timezone.now)
 
+    # Share of the scan capacity this list gets relative to other lists
+    scan_weight = models.PositiveSmallIntegerField(default=1)
+
     objects = models.Manager.from_queryset(ScanListQuerySet)()
 
     def __str__(self) -> str:
@@ -159,8 +164,13 @@ class ScanList(models.Model):
 
         res = False
         for site in self.sites.all():
-            if site.scan() == Site.SCAN_OK:
+            if site.scan(Scan.ORIGIN_LIST, self, dispatch=False) == Site.SCAN_OK:
                 res = True
+
+        if res:
+            # dispatch all queued scans of the list at once
+            from privacyscore.scanner.tasks import dispatch_queued_scans
+            transaction.on_commit(dispatch_queued_scans.delay)
         
         if self.editable:
             self.editable = False
@@ -266,8 +276,8 @@ class BlacklistEntry(models.Model):
 
     def match(self, target_url) -> bool:
         # Split into URL parts
-        extract_target = extract(target_url)
-        extract_self = extract(self.url)
+        extract_target = extract_domain(target_url)
+        extract_self = extract_domain(self.url)
 
         if self.match_type == BlacklistEntry.TYPE_DOMAIN:
             return (extract_target.domain == extract_self.domain and
@@ -327,10 +337,18 @@ class Site(models.Model):
         """Check whether a screenshot for this site exists."""
         return self.get_screenshot() is not None
 
-    def scan(self) -> int:
+    def scan(self, origin: str = None, scan_list: ScanList = None,
+             dispatch: bool = True) -> int:
         """
         Schedule a scan of this site if requirements are fulfilled.
 
+        The origin of the scan determines its priority and defaults to
+        Scan.ORIGIN_BACKGROUND. Interactive scans are started immediately,
+        all other scans are queued and dispatched fairly between the scan
+        lists they have been requested for. Callers queueing many scans
+        should pass dispatch=False and dispatch the queued scans once
+        afterwards.
+
         Returns a status code from the list SCAN_OK, SCAN_COOLDOWN,
         SCAN_BLACKLISTED.
         """
@@ -340,10 +358,20 @@ class Site(models.Model):
             return scan_status
 
         # create Scan
-        scan = Scan.objects.create(site=self)
-
-        from privacyscore.scanner.tasks import schedule_scan
-        schedule_scan.delay(scan.pk)
+        origin = origin or Scan.ORIGIN_BACKGROUND
+        queued = origin != Scan.ORIGIN_INTERACTIVE
+        scan = Scan.objects.create(
+            site=self, origin=origin, scan_list=scan_list, queued=queued,
+            start=None if queued else timezone.now())
+
+        from privacyscore.scanner.tasks import dispatch_queued_scans, \
+            schedule_scan
+        if scan.queued:
+            if dispatch:
+                transaction.on_commit(dispatch_queued_scans.delay)
+        else:
+            transaction.on_commit(lambda: schedule_scan.apply_async(
+                (scan.pk,), priority=scan.priority))
 
         return Site.SCAN_OK
 
@@ -351,15 +379,16 @@ class Site(models.Model):
         now = timezone.now()
 
         # fetch missing attributes
-        if (not hasattr(self, 'last_scan__end_or_null') or
-                not hasattr(self, 'last_scan__start')):
+        if not hasattr(self, 'last_scan__end_or_null'):
             last_scan = self.scans.order_by('end').last()
             self.last_scan__end_or_null = last_scan.end if last_scan else None
-            self.last_scan__start = last_scan.start if last_scan else None
 
-        if ((self.last_scan and 
-                now - self.last_scan.end < settings.SCAN_REQUIRED_TIME_BEFORE_NEXT_SCAN) or
-                (not self.last_scan__end_or_null and self.last_scan__start)):
+        if self.last_scan and \
+                now - self.last_scan.end < settings.SCAN_REQUIRED_TIME_BEFORE_NEXT_SCAN:
+            return Site.SCAN_COOLDOWN
+        # a scan is queued or running; queued scans have not started yet
+        if not self.last_scan__end_or_null and \
+                self.scans.filter(end__isnull=True).exists():
             return Site.SCAN_COOLDOWN
 
         for entry in BlacklistEntry.objects.all():
@@ -428,6 +457,7 @@ class Scan(models.Model):
     A scan of a site belonging.
 
     The state is implicitly stored using start, end, ScanResult and ScanError:
+    * If start is null, the scan is **queued**
     * If start is set, end is null and no ScanResult exists, the scan is
       **running**
     * If start is set, end is set, a ScanResult exists and no ScanError
@@ -436,16 +466,47 @@ class Scan(models.Model):
       ScanError exists, the scan has (partially) **failed**
     * If start is set, end is set and no ScanResult exists, the scan has
       been **aborted**
+
+    Scans which are queued have not been dispatched to the workers yet;
+    their start is set when they are dispatched, so they do not age while
+    they wait. Dispatched scans are aborted after SCAN_TOTAL_TIMEOUT even if
+    they have not been scheduled on the workers.
     """
+    # Scan requested by a user for a single site
+    ORIGIN_INTERACTIVE = 'INT'
+    # Scan of a whole list requested by a user
+    ORIGIN_LIST = 'LST'
+    # Scan scheduled automatically, i.e. rescans
+    ORIGIN_BACKGROUND = 'BGR'
+
+    ORIGIN_CHOICES = [
+        (ORIGIN_INTERACTIVE, "Interactive"),
+        (ORIGIN_LIST, "List"),
+        (ORIGIN_BACKGROUND, "Background"),
+    ]
+
     site = models.ForeignKey(
         Site, on_delete=models.CASCADE, related_name='scans')
 
-    start = models.DateTimeField(default=timezone.now, db_index=True)
+    start = models.DateTimeField(null=True, blank=True, db_index=True)
     end = models.DateTimeField(null=True, blank=True, db_index=True)
 
+    origin = models.CharField(max_length=3, choices=ORIGIN_CHOICES,
+                              default=ORIGIN_BACKGROUND)
+    # The list the scan has been requested for, if any
+    scan_list = models.ForeignKey(
+        ScanList, on_delete=models.SET_NULL, blank=True, null=True,
+        related_name='+')
+    queued = models.BooleanField(default=False, db_index=True)
+
     def __str__(self) -> str:
         return '{}: {}'.format(str(self.site), self.start)
 
+    @property
+    def priority(self) -> int:
+        """The broker priority of the tasks of this scan."""
+        return settings.SCAN_ORIGIN_PRIORITIES[self.origin]
+
     @cached_property
     def result_or_none(self):
         try:
@@ -454,6 +515,30 @@ class Scan(models.Model):
             return None
 
 
+class ScanTestRun(models.Model):
+    """
+    The state of a single test within a running scan.
+
+    A run is created as soon as the test has been scheduled and marked as
+    finished once its results have been received. The processed results
+    themselves are kept in the result store of the scanner. The runs of a
+    scan are removed when the scan has finished.
+    """
+    class Meta:
+        unique_together = (
+            ('scan', 'test'),
+        )
+
+    scan = models.ForeignKey(
+        Scan, on_delete=models.CASCADE, related_name='test_runs')
+    test = models.CharField(max_length=80)
+
+    finished = models.BooleanField(default=False)
+
+    def __str__(self) -> str:
+        return '{}: {}'.format(str(self.scan), self.test)
+
+
 class RawScanResult(models.Model):
     """Raw scan result of a test."""
     scan = models.ForeignKey(
@@ -478,41 +563,74 @@ class RawScanResult(models.Model):
         return self.file_name is None
 
     @staticmethod
-    def store_raw_data(data: bytes, mime_type: str, scan_host: str, test: str,
-                       identifier: str, scan_pk: int):
-        """Store data in db or filesystem."""
-        if len(data) > settings.RAW_DATA_DB_MAX_SIZE:
-            # store in filesystem
-
-            # TODO: ensure uniqueness
-            file_name = str(uuid4())
-            path = os.path.join(settings.RAW_DATA_DIR, file_name)
-            if mime_type in settings.RAW_DATA_UNCOMPRESSED_TYPES:
-                # do not compress
-                with open(path, 'wb') as f:
-                    f.write(data)
-            else:
-                file_name += '.gz'
-                path += '.gz'
-                # compress
-                with gzip.open(path, 'wb') as f:
-                    f.write(data)
-
-            RawScanResult.objects.create(
+    def store_raw_data(raw_data: List[dict], scan_pk: int):
+        """
+        Store raw data elements in db or filesystem.
+
+        Each element is a dict containing mime_type, scan_host, test,
+        identifier and either the data itself or the file_name of data which
+        has already been written to the filesystem by the scan host.
+        Files are written in parallel and all rows are created at once.
+        """
+        objects = [
+            RawScanResult(
                 scan_id=scan_pk,
-                scan_host=scan_host,
-                test=test,
-                identifier=identifier,
-                mime_type=mime_type,
-                file_name=file_name)
+                scan_host=elem['scan_host'],
+                test=elem['test'],
+                identifier=elem['identifier'],
+                mime_type=elem['mime_type'],
+                file_name=elem.get('file_name'),
+                data=elem.get('data'))
+            for elem in raw_data]
+
+        # store large data in filesystem
+        to_write = [
+            obj for obj in objects
+            if obj.data is not None and
+            len(obj.data) > settings.RAW_DATA_DB_MAX_SIZE]
+        if to_write:
+            with ThreadPoolExecutor(max_workers=min(
+                    len(to_write), settings.RAW_DATA_WRITE_WORKERS)) as executor:
+                file_names = executor.map(
+                    lambda obj: RawScanResult.store_file(obj.data, obj.mime_type),
+                    to_write)
+                for obj, file_name in zip(to_write, file_names):
+                    obj.file_name = file_name
+                    obj.data = None
+
+        RawScanResult.objects.bulk_create(objects)
+
+    @staticmethod
+    def store_file(data: bytes, mime_type: str) -> str:
+        """
+        Store data in the filesystem and return its file name.
+
+        Files are named by the hash of their content, thus identical data is
+        only stored once.
+        """
+        file_name = sha256(data).hexdigest()
+        compress = mime_type not in settings.RAW_DATA_UNCOMPRESSED_TYPES
+        if compress:
+            file_name += '.gz'
+        path = os.path.join(settings.RAW_DATA_DIR, file_name)
+
+        if os.path.isfile(path):
+            # refresh modification time as rawdatagc spares recent files only
+            os.utime(path)
+            return file_name
+
+        # write to a temporary file first so that concurrent writers never
+        # expose a partially written file
+        temp_path = '{}.{}.tmp'.format(path, uuid4())
+        if compress:
+            with gzip.open(temp_path, 'wb') as f:
+                f.write(data)
         else:
-            RawScanResult.objects.create(
-                scan_id=scan_pk,
-                scan_host=scan_host,
-                test=test,
-                identifier=identifier,
-                mime_type=mime_type,
-                data=data)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+        os.rename(temp_path, path)
+
+        return file_name
 
     def retrieve(self) -> bytes:
         """Retrieve the raw data."""
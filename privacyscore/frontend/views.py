@@ -553,7 +553,7 @@ def scan_site(request: HttpRequest, site_id: Union[int, None] = None) -> HttpRes
             return render(request, 'frontend/create_site.html', {
                 'form': form,
             })
-    status_code = site.scan()
+    status_code = site.scan(Scan.ORIGIN_INTERACTIVE)
     if status_code == Site.SCAN_OK:
         if not site_id: # if the site is new we want to show the dog
             return redirect(reverse('frontend:scan_site_created', args=(site.pk,)))
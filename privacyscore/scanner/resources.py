@@ -0,0 +1,63 @@
+"""
+Admission control for test suites on a scan host.
+
+Test suites may declare the resources they need by defining test_resources,
+e.g. {'browser': 1}. Each host provides a limited number of tokens per
+resource (SCAN_HOST_RESOURCES). A token is a lock file in
+SCAN_RESOURCE_LOCK_DIR, so the tokens are shared by all worker processes of
+the host.
+"""
+import fcntl
+import os
+from contextlib import contextmanager
+from time import sleep, time
+
+from django.conf import settings
+
+
+class ResourceUnavailable(Exception):
+    """Raised when resource tokens could not be acquired in time."""
+
+
+@contextmanager
+def acquire_resources(resources: dict):
+    """Hold the tokens for the specified resources while in context."""
+    deadline = time() + settings.SCAN_RESOURCE_WAIT_SECONDS
+    held = []
+    try:
+        # acquire in a fixed order to prevent deadlocks
+        for resource in sorted(resources):
+            capacity = settings.SCAN_HOST_RESOURCES.get(resource)
+            if capacity is None:
+                # resource is not limited on this host
+                continue
+            for _ in range(min(resources[resource], capacity)):
+                held.append(_acquire_token(resource, capacity, held, deadline))
+        yield
+    finally:
+        for token in held:
+            token.close()
+
+
+def _acquire_token(resource: str, capacity: int, held: list, deadline: float):
+    if not os.path.isdir(settings.SCAN_RESOURCE_LOCK_DIR):
+        os.makedirs(settings.SCAN_RESOURCE_LOCK_DIR, exist_ok=True)
+    held_paths = {token.name for token in held}
+    while True:
+        for slot in range(capacity):
+            path = os.path.join(
+                settings.SCAN_RESOURCE_LOCK_DIR,
+                '{}.{}.lock'.format(resource, slot))
+            if path in held_paths:
+                continue
+            token = open(path, 'a')
+            try:
+                fcntl.flock(token, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return token
+            except BlockingIOError:
+                token.close()
+        if time() > deadline:
+            raise ResourceUnavailable(
+                'No {} token available within {} seconds'.format(
+                    resource, settings.SCAN_RESOURCE_WAIT_SECONDS))
+        sleep(1)
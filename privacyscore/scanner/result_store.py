@@ -0,0 +1,52 @@
+"""
+A scan-scoped store for the processed results of the tests.
+
+Workers write the processed result of a test into a redis hash belonging to
+the scan instead of returning it to the master. Tests pull the results of the
+tests they depend on from the store, so the task messages only carry a
+reference to the scan.
+"""
+import json
+from typing import Iterable
+
+from django.conf import settings
+from redis import StrictRedis
+
+from privacyscore.scanner.test_suites import SCAN_TEST_SUITE_ORDER
+from privacyscore.utils import get_redis_connection
+
+
+def _get_connection() -> StrictRedis:
+    return get_redis_connection(settings.SCAN_RESULT_STORE_URL)
+
+
+def _get_key(scan_pk: int) -> str:
+    return 'privacyscore:scan:{}:results'.format(scan_pk)
+
+
+def store_result(scan_pk: int, test: str, result: dict):
+    """Store the processed result of a test."""
+    key = _get_key(scan_pk)
+    pipeline = _get_connection().pipeline()
+    pipeline.hset(key, test, json.dumps(result).encode())
+    # do not keep results of aborted scans forever
+    pipeline.expire(key, settings.SCAN_TOTAL_TIMEOUT)
+    pipeline.execute()
+
+
+def get_results(scan_pk: int, tests: Iterable[str]) -> dict:
+    """Get the merged processed results of the specified tests."""
+    tests = set(tests)
+    tests = [test for test in SCAN_TEST_SUITE_ORDER if test in tests]
+    if not tests:
+        return {}
+    result = {}
+    for data in _get_connection().hmget(_get_key(scan_pk), tests):
+        if data is not None:
+            result.update(json.loads(data.decode()))
+    return result
+
+
+def delete_results(scan_pk: int):
+    """Delete all results of a scan."""
+    _get_connection().delete(_get_key(scan_pk))
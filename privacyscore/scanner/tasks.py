@@ -1,125 +1,312 @@
-import os
-from getpass import getuser
-import signal
 import traceback
+from collections import Counter
 from typing import List, Tuple
 from socket import getfqdn
 
-from celery import chord, shared_task
+from celery import shared_task
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
 from django.utils import timezone
 
-from privacyscore.backend.models import RawScanResult, Scan, ScanResult, \
-    ScanError
+from privacyscore.backend.models import RawScanResult, Scan, ScanList, \
+    ScanResult, ScanError, ScanTestRun
+from privacyscore.scanner.resources import acquire_resources
+from privacyscore.scanner.result_store import delete_results, \
+    get_results, store_result
 from privacyscore.scanner.test_suites import AVAILABLE_TEST_SUITES, \
-    TEST_PARAMETERS, SCAN_TEST_SUITE_STAGES
-from privacyscore.utils import get_processes_of_user
+    TEST_PARAMETERS, TEST_DEPENDENCIES, TEST_QUEUES, TEST_REQUIREMENTS, \
+    TEST_RESOURCES
+from privacyscore.test_suites.testssl.common import run_testssl_batch
+from privacyscore.utils import ProcessSupervisor
 
 
-class Timeout:
-    def __init__(self, seconds=1):
-        self.seconds = seconds
+# Arbitrary id of the advisory lock serializing the dispatcher
+DISPATCH_LOCK_ID = 4711
 
-    def __enter__(self):
-        def handle_timeout(signum, frame):
-            # kill all possible processes
-            # TODO: this is a really bad idea
-            # TODO: Especially with multiple worker threads, bad things are inevitable
-            own_procs = get_processes_of_user(getuser())
-            for pid, cmdline in own_procs:
-                # TODO: Argh
-                if '/tests/' not in cmdline:
-                    continue
-                os.kill(pid, 9)
-            raise TimeoutError
 
-        signal.signal(signal.SIGALRM, handle_timeout)
-        signal.alarm(self.seconds)
+# Slots are freed as soon as possible, so the dispatcher does not queue
+# behind the tasks of interactive scans.
+@shared_task(queue='master',
+             priority=max(settings.SCAN_ORIGIN_PRIORITIES.values()))
+def dispatch_queued_scans():
+    """
+    Dispatch queued scans as long as the number of running scans is below
+    SCAN_MAX_RUNNING.
+
+    Each slot is assigned to the scan list with the lowest number of running
+    scans relative to its weight, unless the list has SCAN_LIST_MAX_RUNNING
+    running scans already. Queued scans not belonging to a list are treated
+    as another list with weight SCAN_UNLISTED_WEIGHT.
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [DISPATCH_LOCK_ID])
+
+        running = Counter(dict(Scan.objects.filter(
+            queued=False, end__isnull=True).values_list(
+            'scan_list').annotate(Count('id')).order_by()))
+        pending = dict(Scan.objects.filter(queued=True).values_list(
+            'scan_list').annotate(Count('id')).order_by())
+        weights = dict(ScanList.objects.filter(
+            pk__in=pending).values_list('pk', 'scan_weight'))
+        weights[None] = settings.SCAN_UNLISTED_WEIGHT
 
-    def __exit__(self, type, value, traceback):
-        signal.alarm(0)
+        to_dispatch = _allocate_slots(running, pending, weights)
+        for scan_list, count in to_dispatch.items():
+            scans = list(Scan.objects.filter(
+                queued=True, scan_list=scan_list).order_by('pk')[:count])
+            # The start is set at once, so a scan whose schedule_scan task
+            # is lost is aborted by handle_aborted_scans and does not keep
+            # its slot.
+            Scan.objects.filter(pk__in=[s.pk for s in scans]).update(
+                queued=False, start=timezone.now())
+            for scan in scans:
+                transaction.on_commit(schedule_scan.si(scan.pk).set(
+                    priority=scan.priority).apply_async)
+
+
+def _allocate_slots(running: Counter, pending: dict, weights: dict) -> Counter:
+    """
+    Get the number of queued scans to dispatch per scan list.
+
+    running and pending map the scan lists (or None) to their numbers of
+    running and queued scans, weights maps them to their weights.
+    """
+    running = Counter(running)
+    to_dispatch = Counter()
+    free = settings.SCAN_MAX_RUNNING - sum(running.values())
+    while free > 0:
+        candidates = [
+            scan_list for scan_list, count in pending.items()
+            if count > to_dispatch[scan_list] and
+            running[scan_list] < settings.SCAN_LIST_MAX_RUNNING]
+        if not candidates:
+            break
+        scan_list = min(candidates, key=lambda scan_list: (
+            running[scan_list] / max(weights[scan_list], 1),
+            scan_list is not None, scan_list or 0))
+        to_dispatch[scan_list] += 1
+        running[scan_list] += 1
+        free -= 1
+    return to_dispatch
 
 
 @shared_task(queue='master')
 def schedule_scan(scan_pk: int):
     """Prepare and schedule a scan."""
-    scan = Scan.objects.get(pk=scan_pk)
-    scan.start = timezone.now()
-    scan.save()
+    with transaction.atomic():
+        try:
+            scan = Scan.objects.select_for_update().get(pk=scan_pk)
+        except Scan.DoesNotExist:
+            # scan has been aborted in the meantime
+            return
+        if scan.start is None:
+            scan.start = timezone.now()
+            scan.save()
 
-    # Schedule next stage
-    schedule_scan_stage(
-        (getfqdn(), 'privacyscore.scanner.tasks.schedule_scan', [], {}),
-        {},
-        scan_pk)
+        # Schedule all tests without dependencies
+        _schedule_ready_tests(scan)
 
 
 @shared_task(queue='master')
-def schedule_scan_stage(new_results: Tuple[list, dict, dict],
-                        previous_results: Tuple[list, dict, dict],
-                        scan_pk: int,
-                        stage: int = 0,
-                        previous_task_count: int = 0):
-    """Schedule the next stage for a scan."""
-    scan = Scan.objects.get(pk=scan_pk)
-
-    if previous_task_count <= 1:
-        new_results = [new_results]
-    raw_data, new_results, errors = _parse_new_results(new_results)
-    previous_results.update(new_results)
-
-    # store raw data in database
-    for params in raw_data:
-        RawScanResult.store_raw_data(scan_pk=scan_pk, **params)
-
-    # store errors in database
-    for error in errors:
-        test = None
-        if ':' in error:
-            scan_host, test, error = error.split(':', maxsplit=2)
+def handle_test_result(new_result: Tuple[str, str, dict],
+                       scan_pk: int, test: str):
+    """
+    Store the result of a single test and schedule all tests depending on it.
+    """
+    with transaction.atomic():
+        try:
+            scan = Scan.objects.select_for_update().get(pk=scan_pk)
+        except Scan.DoesNotExist:
+            # scan has been aborted in the meantime
+            return False
+
+        if not scan.test_runs.filter(test=test, finished=False).exists():
+            # the run has been finished by handle_test_error already
+            return False
+
+        raw_data, errors = _parse_new_results([new_result])
+
+        # store raw data in database
+        RawScanResult.store_raw_data(raw_data, scan_pk)
+
+        # store errors in database
+        scan_errors = []
+        for error in errors:
+            scan_host, error_test = '', None
+            if ':' in error:
+                scan_host, error_test, error = error.split(':', maxsplit=2)
+            scan_errors.append(ScanError(
+                scan_host=scan_host, scan=scan, test=error_test, error=error))
+        ScanError.objects.bulk_create(scan_errors)
+
+        scan.test_runs.filter(test=test).update(finished=True)
+
+        return _schedule_ready_tests(scan)
+
+
+@shared_task(queue='master')
+def handle_test_error(scan_pk: int, test: str):
+    """
+    Finish the run of a test whose task failed without returning a result,
+    e.g. because it exceeded its hard time limit or its worker died.
+    """
+    with transaction.atomic():
+        try:
+            scan = Scan.objects.select_for_update().get(pk=scan_pk)
+        except Scan.DoesNotExist:
+            # scan has been aborted in the meantime
+            return False
+
+        if not scan.test_runs.filter(test=test, finished=False).update(
+                finished=True):
+            return False
         ScanError.objects.create(
-            scan_host=scan_host, scan=scan, test=test, error=error)
+            scan=scan, test=test,
+            error='Test did not return a result. It has been killed or its '
+                  'worker has been lost.')
+
+        return _schedule_ready_tests(scan)
 
-    if stage >= len(SCAN_TEST_SUITE_STAGES):
-        # all stages finished.
+
+def _schedule_ready_tests(scan: Scan) -> bool:
+    """
+    Schedule all tests of a scan whose dependencies have finished, or store
+    the final result if all tests have finished.
+
+    Has to be called within a transaction holding a lock on the scan.
+    Returns whether the scan has finished.
+    """
+    runs = {run.test: run for run in scan.test_runs.all()}
+    finished = {test for test, run in runs.items() if run.finished}
+
+    if len(finished) == len(TEST_DEPENDENCIES):
+        # all tests finished.
         handle_finished_scan(scan)
 
         # store final results
         ScanResult.objects.create(
-            scan=scan, result=previous_results)
+            scan=scan, result=get_results(scan.pk, finished))
+        scan.test_runs.all().delete()
+        transaction.on_commit(lambda: delete_results(scan.pk))
+
+        # a slot for a queued scan is available now
+        transaction.on_commit(dispatch_queued_scans.delay)
 
         return True
 
-    tasks = []
-    for test_suite in SCAN_TEST_SUITE_STAGES[stage]:
-        tasks.append(run_test.s(test_suite, scan.site.url, previous_results))
-    chord(tasks, schedule_scan_stage.s(previous_results, scan_pk, stage + 1, len(tasks))).apply_async()
+    for test in _get_ready_tests(TEST_DEPENDENCIES, set(runs), finished):
+        ScanTestRun.objects.create(scan=scan, test=test)
+        test_task = run_test.s(test, scan.site.url, scan.pk).set(
+            queue=TEST_QUEUES[test], priority=scan.priority)
+        # run_test reports its errors as result, so the errback is only
+        # called if it has been killed
+        test_task.link_error(handle_test_error.si(scan.pk, test).set(
+            priority=scan.priority))
+        task = test_task | handle_test_result.s(scan.pk, test).set(
+            priority=scan.priority)
+        # do not start the test before its run has been committed
+        transaction.on_commit(task.apply_async)
+
+    return False
+
+
+def _get_ready_tests(dependencies: dict, started: set, finished: set) -> list:
+    """
+    Get the tests which have not been started yet and whose dependencies
+    have finished.
+    """
+    return [
+        test for test, test_dependencies in dependencies.items()
+        if test not in started and test_dependencies <= finished]
 
 
 def handle_finished_scan(scan: Scan):
     """
-    Callback when all stages of tasks for a scan are completed.
+    Callback when all tests of a scan are completed.
     """
     scan.end = timezone.now()
     scan.save()
 
 
-@shared_task(queue='slave')
-def run_test(test_suite: str, url: str, previous_results: dict) -> bool:
-    """Run a single test against a single url."""
+# The soft time limit covers waiting for resources and leaves the supervisor
+# some time to terminate the subprocesses of a test suite which exceeds its
+# deadline. The deadline of the test suite itself starts when the supervisor
+# is entered; with a threaded pool, hangs within python code are only
+# covered by this looser limit (see ProcessSupervisor).
+@shared_task(queue='slave',
+             soft_time_limit=settings.SCAN_RESOURCE_WAIT_SECONDS +
+             settings.SCAN_SUITE_TIMEOUT_SECONDS + 30)
+def run_test(test_suite: str, url: str, scan_pk: int) -> bool:
+    """
+    Run a single test against a single url.
+
+    The processed result is written to the result store; only the raw data is
+    returned. If enabled, large raw data is written to the raw data directory
+    directly and only its file name is returned.
+    """
     test_parameters = TEST_PARAMETERS[test_suite]
+    requirements = TEST_REQUIREMENTS[test_suite]
+    resources = TEST_RESOURCES[test_suite]
     test_suite = AVAILABLE_TEST_SUITES[test_suite]
     try:
-        with Timeout(settings.SCAN_SUITE_TIMEOUT_SECONDS):
+        previous_results = get_results(scan_pk, requirements)
+        with acquire_resources(resources), \
+                ProcessSupervisor(settings.SCAN_SUITE_TIMEOUT_SECONDS):
             raw_data = test_suite.test_site(
                 url, previous_results, **test_parameters)
             processed = test_suite.process_test_data(
                 raw_data, previous_results, **test_parameters)
-            return getfqdn(), test_suite.test_name, raw_data, processed
+            store_result(scan_pk, test_suite.test_name, processed)
+            if settings.RAW_DATA_UPLOAD:
+                raw_data = _upload_raw_data(raw_data)
+            return getfqdn(), test_suite.test_name, raw_data
     except Exception as e:
         return ':'.join([getfqdn(), test_suite.test_name, traceback.format_exc()])
 
 
+@shared_task(queue='slave',
+             soft_time_limit=settings.SCAN_RESOURCE_WAIT_SECONDS +
+             settings.SCAN_SUITE_TIMEOUT_SECONDS + 30)
+def prefetch_testssl(hostnames: List[str], check_mx: bool = False,
+                     cache_timeout: int = None):
+    """
+    Test a batch of hosts with a single invocation of testssl.
+
+    The results are cached, so the testssl test suites of the following scans
+    of these hosts do not need to run testssl themselves. A cache timeout
+    exceeding the one of the test suite may be given to keep the results
+    until queued scans have started.
+    """
+    test = 'testssl_mx' if check_mx else 'testssl_https'
+    if not TEST_PARAMETERS[test].get('cache_timeout') or \
+            TEST_PARAMETERS[test].get('remote_host'):
+        # the results could not be used by the test suite
+        return
+    cache_timeout = max(
+        cache_timeout or 0, TEST_PARAMETERS[test]['cache_timeout'])
+    # All hosts are tested in parallel and need the resources of a test
+    # each. Hosts exceeding the resources of this host are tested by
+    # separate tasks.
+    batch_size = len(hostnames)
+    for resource, amount in TEST_RESOURCES[test].items():
+        capacity = settings.SCAN_HOST_RESOURCES.get(resource)
+        if capacity is not None and amount > 0:
+            batch_size = min(batch_size, max(capacity // amount, 1))
+    for i in range(batch_size, len(hostnames), batch_size):
+        prefetch_testssl.delay(
+            hostnames[i:i + batch_size], check_mx, cache_timeout)
+    hostnames = hostnames[:batch_size]
+
+    resources = {
+        resource: amount * len(hostnames)
+        for resource, amount in TEST_RESOURCES[test].items()}
+    with acquire_resources(resources), \
+            ProcessSupervisor(settings.SCAN_SUITE_TIMEOUT_SECONDS):
+        run_testssl_batch(hostnames, check_mx, cache_timeout)
+
+
 @shared_task(queue='master')
 def handle_aborted_scans():
     """
@@ -129,16 +316,33 @@ def handle_aborted_scans():
     now = timezone.now()
     Scan.objects.filter(
         start__lt=now - settings.SCAN_TOTAL_TIMEOUT,
-        end__isnull=True).delete()
+        end__isnull=True, queued=False).delete()
+
+    # dispatch queued scans in the slots that have become available
+    dispatch_queued_scans.delay()
+
+
+def _upload_raw_data(raw_data: dict) -> dict:
+    """
+    Write large raw data to the filesystem and replace it by its file name.
+    """
+    uploaded = {}
+    for identifier, raw_elem in raw_data.items():
+        if len(raw_elem['data']) > settings.RAW_DATA_DB_MAX_SIZE:
+            raw_elem = {
+                'mime_type': raw_elem['mime_type'],
+                'file_name': RawScanResult.store_file(
+                    raw_elem['data'], raw_elem['mime_type']),
+            }
+        uploaded[identifier] = raw_elem
+    return uploaded
 
 
-def _parse_new_results(previous_results: List[Tuple[list, dict]]) -> tuple:
+def _parse_new_results(previous_results: List[Tuple[str, str, dict]]) -> tuple:
     """
-    Parse previous results, split into raw data, results and errors and merge
-    data from multiple test suites.
+    Parse previous results and split them into raw data and errors.
     """
     raw = []
-    result = {}
     errors = []
     for e in previous_results:
         if isinstance(e, (list, tuple)):
@@ -152,8 +356,6 @@ def _parse_new_results(previous_results: List[Tuple[list, dict]]) -> tuple:
                         scan_host=scan_host,
                         test=test,
                         **raw_elem))
-            if isinstance(e[3], dict):
-                result.update(e[3])
         else:
             errors.append(e)
-    return raw, result, errors
+    return raw, errors
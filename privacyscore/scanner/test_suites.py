@@ -2,14 +2,15 @@
 This module loads all test suites from the test_suites directory
 and makes them accessible by their name.
 
-In addition, it generates the stages in which to run tests.
+In addition, it generates the dependency graph which determines when a test
+can be scheduled, and determines the resources and queue of each test.
 """
 import os
 from importlib import import_module
 from sys import stderr
 
 from django.conf import settings
-from toposort import toposort
+from toposort import toposort_flatten
 
 
 # Collect parameters for tests
@@ -43,12 +44,45 @@ for base_module in settings.TEST_SUITES_BASEMODULES:
         AVAILABLE_TEST_SUITES[test_module.test_name] = test_module
 
 
-# Generate stages based on dependencies.
+# Generate dependency graph.
 TEST_DEPENDENCIES = {}
 for test in (t[0] for t in settings.SCAN_TEST_SUITES):
     if test not in AVAILABLE_TEST_SUITES:
         continue
     TEST_DEPENDENCIES[test] = set(AVAILABLE_TEST_SUITES[test].test_dependencies)
 
+# A test depending on a test which is not available would never be scheduled.
+for test, dependencies in TEST_DEPENDENCIES.items():
+    missing = dependencies - set(TEST_DEPENDENCIES)
+    if missing:
+        print('Test suite {} depends on unavailable test suites {}'.format(
+            test, ', '.join(sorted(missing))), file=stderr)
+        dependencies -= missing
 
-SCAN_TEST_SUITE_STAGES = list(toposort(TEST_DEPENDENCIES))
+# The order in which the results of the tests are merged.
+SCAN_TEST_SUITE_ORDER = toposort_flatten(TEST_DEPENDENCIES)
+
+
+def _get_requirements(test: str) -> set:
+    """Get all tests a test depends on, directly or indirectly."""
+    requirements = set()
+    for dependency in TEST_DEPENDENCIES[test]:
+        requirements.add(dependency)
+        requirements.update(_get_requirements(dependency))
+    return requirements
+
+
+TEST_REQUIREMENTS = {test: _get_requirements(test) for test in TEST_DEPENDENCIES}
+
+
+# Resources required by the tests and the queues to route them to.
+TEST_RESOURCES = {}
+TEST_QUEUES = {}
+for test in TEST_DEPENDENCIES:
+    TEST_RESOURCES[test] = getattr(
+        AVAILABLE_TEST_SUITES[test], 'test_resources', {})
+    TEST_QUEUES[test] = 'slave'
+    for resource in sorted(TEST_RESOURCES[test]):
+        if resource in settings.SCAN_RESOURCE_QUEUES:
+            TEST_QUEUES[test] = settings.SCAN_RESOURCE_QUEUES[resource]
+            break
@@ -1,3 +1,427 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from collections import Counter
+from contextlib import closing
+from time import sleep, time
+from unittest import mock
 
-# Create your tests here.
+from adblockparser import AdblockRules
+from django.test import SimpleTestCase, override_settings
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from privacyscore.scanner import tasks
+from privacyscore.scanner.resources import ResourceUnavailable, \
+    acquire_resources
+from privacyscore.test_suites import network, openwpm, serverleak
+from privacyscore.test_suites.testssl import common as testssl
+from privacyscore.utils import ProcessSupervisor, get_supervisor_deadline, \
+    supervised_call
+
+
+# A fixed snapshot of rules in the forms found in EasyList and EasyPrivacy.
+EASYLIST_SNAPSHOT = """\
+[Adblock Plus 2.0]
+! Title: EasyList snapshot
+||doubleclick.net^
+||google-analytics.com^
+||Scorecardresearch.com^
+||facebook.com/tr/
+||ads.example.com^$third-party
+||tracker.example^$script,domain=~example.org
+||adserver.example.net^|
+|http://banner.
+|https://pixel.
+&ad_type=
+/adframe.
+-tracking-pixel-
+.com/ads/$image
+://ads.*/track?
+analytics.example.org^
+example.info/stats.
+@@||doubleclick.net/safe/
+##.advertisement
+example.com##.banner
+"""
+
+URL_SAMPLE = [
+    'http://doubleclick.net/',
+    'https://ad.doubleclick.net/ddm/activity',
+    'https://DOUBLECLICK.NET:443/x',
+    'https://user@stats.doubleclick.net/',
+    'https://doubleclick.net.example.com/',
+    'https://notdoubleclick.net/',
+    'https://example.com/?ref=doubleclick.net',
+    'https://example.com/doubleclick.net/',
+    'https://www.google-analytics.com/analytics.js',
+    'https://google-analytics.com.evil.example/collect',
+    'https://sb.scorecardresearch.com/beacon.js',
+    'https://www.facebook.com/tr/?id=1',
+    'https://www.facebook.com/profile',
+    'https://ads.example.com/banner.png',
+    'https://tracker.example/t.js',
+    'https://adserver.example.net/',
+    'https://adserver.example.net/ad.js',
+    'http://banner.example.com/',
+    'https://banner.example.com/',
+    'https://pixel.example.com/p.gif',
+    'https://example.com/view?id=1&ad_type=video',
+    'https://example.com/adframe.html',
+    'https://example.com/img-tracking-pixel-1.gif',
+    'https://example.com/ads/1.png',
+    'https://ads.example.net/track?id=1',
+    'https://analytics.example.org/a.js',
+    'https://example.org/analytics.example.org',
+    'https://example.info/stats.js',
+    'wss://doubleclick.net/socket',
+    'data:text/plain,doubleclick.net',
+    'doubleclick.net',
+    'https://example.com/',
+]
+
+
+class TrackerMatcherTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'easylist.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(EASYLIST_SNAPSHOT)
+        patchers = [
+            mock.patch.object(openwpm, 'EASYLIST_PATHS', [path]),
+            mock.patch.object(openwpm, 'EASYLIST_CACHE_PATH', os.path.join(
+                self.directory, 'rules.pickle')),
+            mock.patch.object(openwpm, '_tracker_rules', None),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertMatchesAdblockRules(self, matcher):
+        rules = AdblockRules(openwpm._read_tracker_rules())
+        domain_cache = {}
+        for url in URL_SAMPLE:
+            with self.subTest(url=url):
+                self.assertEqual(
+                    matcher.should_block(url), rules.should_block(url))
+                self.assertEqual(
+                    matcher.should_block(url, domain_cache),
+                    rules.should_block(url))
+
+    def test_should_block(self):
+        matcher = openwpm.TrackerMatcher(
+            *openwpm.TrackerMatcher.parse(openwpm._read_tracker_rules()))
+        self.assertTrue(matcher.domains)
+        self.assertMatchesAdblockRules(matcher)
+
+    def test_should_block_cached(self):
+        self.assertMatchesAdblockRules(openwpm.get_tracker_rules())
+        self.assertTrue(os.path.exists(openwpm.EASYLIST_CACHE_PATH))
+        # a matcher built from the cache
+        self.assertMatchesAdblockRules(openwpm._load_tracker_rules())
+
+
+class CrawlDatabaseTestCase(SimpleTestCase):
+    SITE_URLS = [
+        'http://example.com/',
+        'http://www.example.com/',
+        'http://example.com/other',
+        'http://example_com/',
+    ]
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'crawl-data.sqlite3')
+        with closing(sqlite3.connect(path)) as conn:
+            conn.execute(
+                'CREATE TABLE crawl (crawl_id INTEGER, start_time TEXT)')
+            conn.execute(
+                'CREATE TABLE site_visits '
+                '(visit_id INTEGER, crawl_id INTEGER, site_url TEXT)')
+            for i, site_url in enumerate(self.SITE_URLS):
+                conn.execute(
+                    'INSERT INTO crawl VALUES (?, ?)', (i, str(i)))
+                conn.execute(
+                    'INSERT INTO site_visits VALUES (?, ?, ?)',
+                    (i, i, site_url))
+            conn.commit()
+        with open(path, 'rb') as f:
+            self.data = f.read()
+
+    def assertVisitsOf(self, conn, url, visit_ids):
+        self.assertEqual(openwpm._get_visits(conn, url)[1], visit_ids)
+
+    def test_get_visits(self):
+        with openwpm._open_crawl_database(self.data) as conn:
+            self.assertVisitsOf(conn, 'http://example.com/', [0])
+            # normalized like the url of the visit
+            self.assertVisitsOf(conn, 'example.com', [0])
+            self.assertVisitsOf(conn, 'http://example.com/other', [2])
+            self.assertVisitsOf(conn, 'http://example_com/', [3])
+            self.assertVisitsOf(conn, 'http://example.org/', [])
+
+    def test_temporary_database(self):
+        # sqlite3 without support for deserializing databases
+        with mock.patch.object(
+                openwpm.sqlite3, 'connect',
+                return_value=mock.Mock(spec=['close'])):
+            database = openwpm._open_crawl_database(self.data)
+        self.assertIsInstance(database, openwpm._TemporaryDatabase)
+        with database as conn:
+            self.assertVisitsOf(conn, 'example.com', [0])
+        self.assertFalse(os.path.exists(database.file.name))
+
+
+class TestsslCacheTestCase(SimpleTestCase):
+    """The cache of testssl results is optional if redis is not available."""
+    def setUp(self):
+        redis = mock.Mock()
+        for method in ('exists', 'get', 'set', 'delete'):
+            getattr(redis, method).side_effect = RedisConnectionError('down')
+        patchers = [
+            mock.patch.object(
+                testssl, 'get_redis_connection', return_value=redis),
+            mock.patch.object(
+                testssl, '_run_testssl', return_value=b'{"scanResult": []}'),
+            mock.patch.object(testssl, '_local_testssl_batch'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_run_testssl(self):
+        self.assertEqual(
+            testssl.run_testssl('example.com', False, cache_timeout=3600),
+            b'{"scanResult": []}')
+        testssl._run_testssl.assert_called_once_with(
+            'example.com', False, None)
+
+    def test_cached_testssl(self):
+        self.assertIsNone(
+            testssl.get_cached_testssl('example.com', False, 'fingerprint'))
+        testssl.cache_testssl(
+            'example.com', False, 'fingerprint', b'{"scanResult": []}', 3600)
+
+    def test_run_testssl_batch(self):
+        testssl.run_testssl_batch(['example.com'], False, 3600)
+        testssl._local_testssl_batch.assert_not_called()
+
+
+class AllocateSlotsTestCase(SimpleTestCase):
+    @override_settings(SCAN_MAX_RUNNING=4, SCAN_LIST_MAX_RUNNING=10)
+    def test_weights(self):
+        self.assertEqual(tasks._allocate_slots(
+            Counter(), {1: 10, 2: 10}, {1: 1, 2: 3, None: 1}),
+            Counter({1: 1, 2: 3}))
+
+    @override_settings(SCAN_MAX_RUNNING=5, SCAN_LIST_MAX_RUNNING=10)
+    def test_running(self):
+        # only free slots are allocated, to the list with less running scans
+        self.assertEqual(tasks._allocate_slots(
+            Counter({1: 3}), {1: 5, 2: 5}, {1: 1, 2: 1, None: 1}),
+            Counter({2: 2}))
+        self.assertEqual(tasks._allocate_slots(
+            Counter({1: 3, 2: 2}), {1: 5, 2: 5}, {1: 1, 2: 1, None: 1}),
+            Counter())
+
+    @override_settings(SCAN_MAX_RUNNING=10, SCAN_LIST_MAX_RUNNING=3)
+    def test_list_max_running(self):
+        self.assertEqual(tasks._allocate_slots(
+            Counter({1: 1}), {1: 10, None: 10}, {1: 1, None: 1}),
+            Counter({1: 2, None: 3}))
+
+    @override_settings(SCAN_MAX_RUNNING=10, SCAN_LIST_MAX_RUNNING=10)
+    def test_pending(self):
+        self.assertEqual(tasks._allocate_slots(
+            Counter(), {1: 1, None: 2}, {1: 5, None: 1}),
+            Counter({1: 1, None: 2}))
+
+    @override_settings(SCAN_MAX_RUNNING=1, SCAN_LIST_MAX_RUNNING=10)
+    def test_unlisted_first(self):
+        self.assertEqual(tasks._allocate_slots(
+            Counter(), {1: 1, None: 1}, {1: 1, None: 1}),
+            Counter({None: 1}))
+
+
+class ReadyTestsTestCase(SimpleTestCase):
+    DEPENDENCIES = {
+        'network': set(),
+        'serverleak': set(),
+        'tlsprobe': {'network'},
+        'openwpm': {'network'},
+        'testssl_https': {'network', 'tlsprobe'},
+    }
+
+    def assertReadyTests(self, started, finished, ready):
+        self.assertEqual(sorted(tasks._get_ready_tests(
+            self.DEPENDENCIES, started, finished)), ready)
+
+    def test_ready_tests(self):
+        self.assertReadyTests(set(), set(), ['network', 'serverleak'])
+        self.assertReadyTests({'network', 'serverleak'}, set(), [])
+        self.assertReadyTests(
+            {'network', 'serverleak'}, {'network'}, ['openwpm', 'tlsprobe'])
+        # a test waits for all of its dependencies
+        self.assertReadyTests(
+            {'network', 'serverleak', 'openwpm', 'tlsprobe'},
+            {'network', 'openwpm'}, [])
+        self.assertReadyTests(
+            {'network', 'serverleak', 'openwpm', 'tlsprobe'},
+            {'network', 'tlsprobe'}, ['testssl_https'])
+        self.assertReadyTests(
+            set(self.DEPENDENCIES), set(self.DEPENDENCIES), [])
+
+
+class ProcessSupervisorTestCase(SimpleTestCase):
+    def test_subprocess_timeout(self):
+        start = time()
+        with self.assertRaises(TimeoutError):
+            with ProcessSupervisor(1):
+                supervised_call(['sleep', '10'])
+        self.assertLess(time() - start, 5)
+
+    def test_python_timeout(self):
+        start = time()
+        with self.assertRaises(TimeoutError):
+            with ProcessSupervisor(1):
+                sleep(10)
+        self.assertLess(time() - start, 5)
+
+    def test_per_thread(self):
+        deadlines = {}
+
+        def run(i):
+            with ProcessSupervisor(10 + i) as supervisor:
+                sleep(0.2)
+                deadlines[i] = supervisor.deadline == get_supervisor_deadline()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(deadlines, {0: True, 1: True, 2: True})
+        self.assertIsNone(get_supervisor_deadline())
+
+    def test_nested(self):
+        with ProcessSupervisor(10) as outer:
+            with ProcessSupervisor(5) as inner:
+                self.assertEqual(get_supervisor_deadline(), inner.deadline)
+            self.assertEqual(get_supervisor_deadline(), outer.deadline)
+        self.assertIsNone(get_supervisor_deadline())
+
+
+class AcquireResourcesTestCase(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = override_settings(
+            SCAN_HOST_RESOURCES={'browser': 2},
+            SCAN_RESOURCE_LOCK_DIR=os.path.join(directory, 'locks'),
+            SCAN_RESOURCE_WAIT_SECONDS=0)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def test_capacity(self):
+        with acquire_resources({'browser': 1}):
+            with acquire_resources({'browser': 1}):
+                with self.assertRaises(ResourceUnavailable):
+                    with acquire_resources({'browser': 1}):
+                        pass
+        # the tokens have been released
+        with acquire_resources({'browser': 2}):
+            pass
+
+    def test_capped_request(self):
+        # requests exceeding the capacity of the host are capped
+        with acquire_resources({'browser': 3}):
+            with self.assertRaises(ResourceUnavailable):
+                with acquire_resources({'browser': 1}):
+                    pass
+
+    def test_unlimited(self):
+        with acquire_resources({'browser': 2, 'cpu': 100}):
+            pass
+
+
+class ContentSignatureTestCase(SimpleTestCase):
+    PAGE = (b'<html>\n<body>\n<p>PrivacyScore scans websites for privacy '
+            b'and security issues</p> <a href="/about">about</a>\n'
+            b'</body>\n</html>')
+    OTHER_PAGE = (b'<html>\n<body>\n<p>PrivacyScore ranks websites by '
+                  b'privacy and security</p> <a href="/">home</a>\n'
+                  b'</body>\n</html>')
+
+    def get_signature(self, page: bytes, size: int, chunk_size: int) -> list:
+        signature = network._ContentSignature(size)
+        for i in range(0, len(page), chunk_size):
+            signature.update(page[i:i + chunk_size])
+        return signature.finish()
+
+    def test_chunks(self):
+        # tokens split between chunks do not change the signature
+        signature = self.get_signature(self.PAGE, 512, len(self.PAGE))
+        for chunk_size in (1, 3, 7, 64):
+            self.assertEqual(
+                self.get_signature(self.PAGE, 512, chunk_size), signature)
+
+    def test_exact_similarity(self):
+        # signatures of small pages contain all tokens
+        self.assertAlmostEqual(network._signature_similarity(
+            self.get_signature(self.PAGE, 512, 16),
+            self.get_signature(self.OTHER_PAGE, 512, 16), 512),
+            network._jaccard_index(self.PAGE, self.OTHER_PAGE))
+        self.assertEqual(network._signature_similarity(
+            self.get_signature(self.PAGE, 512, 16),
+            self.get_signature(self.PAGE, 512, 16), 512), 1)
+
+    def test_estimated_similarity(self):
+        page = b' '.join(b'a%d' % i for i in range(4000))
+        other_page = b' '.join(b'a%d' % i for i in range(2000, 6000))
+        self.assertAlmostEqual(network._signature_similarity(
+            self.get_signature(page, 512, 4096),
+            self.get_signature(other_page, 512, 4096), 512),
+            network._jaccard_index(page, other_page), delta=0.1)
+
+
+class TrialsTestCase(SimpleTestCase):
+    TRIALS = [
+        {'path': 'server-status/', 'match': 'Server Status'},
+        {'path': '{domain}.sql', 'match': ['CREATE TABLE', 'TABLE']},
+        {'path': '.git/HEAD', 'regex': '^ref: '},
+    ]
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'trials.json')
+        with open(path, 'w') as f:
+            json.dump(self.TRIALS, f)
+        self.trials = serverleak._Trials(path)
+
+    def test_plan(self):
+        self.assertEqual(self.trials.plan('http://www.example.com/'), [
+            ('server-status/', 0), ('example.sql', 1), ('.git/HEAD', 2)])
+        # trials with placeholders need the url
+        self.assertEqual(self.trials.plan(None), [
+            ('server-status/', 0), ('.git/HEAD', 2)])
+
+    def test_find_strings(self):
+        # strings contained in longer strings are found as well
+        self.assertEqual(
+            self.trials.find_strings('CREATE TABLE x; Server Status'),
+            {'CREATE TABLE', 'TABLE', 'Server Status'})
+        self.assertEqual(self.trials.find_strings('nothing'), set())
+
+    def test_is_leak(self):
+        self.assertTrue(self.trials.is_leak(0, '<h1>Server Status</h1>'))
+        self.assertFalse(self.trials.is_leak(0, 'TABLE'))
+        self.assertTrue(self.trials.is_leak(1, 'DROP TABLE x;'))
+        self.assertTrue(self.trials.is_leak(2, 'ref: refs/heads/master'))
+        self.assertFalse(self.trials.is_leak(2, '<html>ref: </html>'))
@@ -0,0 +1,122 @@
+"""
+DNS resolution shared by the test suites.
+
+Answers are cached according to the TTL of their records. Nonexistent names
+and empty answers are cached as well (negative caching). The cache is kept
+per process and, if SCAN_DNS_CACHE_URL is set, shared between all worker
+processes using redis. If redis is not available, names are resolved without
+the shared cache.
+"""
+import json
+from threading import Lock
+from time import time
+from typing import List
+
+from django.conf import settings
+from dns import rdata, rdataclass, rdatatype, resolver
+from redis import RedisError
+
+from privacyscore.utils import get_redis_connection
+
+
+# Upper bound in seconds for how long an answer is cached.
+MAX_TTL = 86400
+
+# Maximum number of answers cached per process.
+MAX_ENTRIES = 10000
+
+_cache = {}
+_cache_lock = Lock()
+
+_NEGATIVE_ANSWERS = {
+    'nxdomain': resolver.NXDOMAIN,
+    'noanswer': resolver.NoAnswer,
+}
+
+
+def query(name: str, rdtype: str) -> List[rdata.Rdata]:
+    """
+    Resolve name and return the records of type rdtype.
+
+    Raises the same exceptions as dns.resolver.query. Negative answers are
+    raised from the cache as NXDOMAIN and NoAnswer respectively.
+    """
+    key = 'privacyscore:dns:{}:{}'.format(rdtype, name.lower().rstrip('.'))
+
+    entry = _get_local(key)
+    if entry is None and settings.SCAN_DNS_CACHE_URL:
+        entry = _get_shared(key)
+        if entry is not None:
+            _set_local(key, entry)
+    if entry is None:
+        entry = _resolve(name, rdtype)
+        if entry[0] > time():
+            _set_local(key, entry)
+            if settings.SCAN_DNS_CACHE_URL:
+                _set_shared(key, entry)
+
+    value = entry[1]
+    if isinstance(value, str):
+        raise _NEGATIVE_ANSWERS[value]
+    return [
+        rdata.from_text(rdataclass.IN, rdatatype.from_text(rdtype), record)
+        for record in value]
+
+
+def _resolve(name: str, rdtype: str) -> tuple:
+    """Query the resolver and return the entry to cache."""
+    try:
+        answer = resolver.query(name, rdtype)
+    except resolver.NXDOMAIN:
+        return time() + settings.SCAN_DNS_NEGATIVE_TTL, 'nxdomain'
+    except resolver.NoAnswer:
+        return time() + settings.SCAN_DNS_NEGATIVE_TTL, 'noanswer'
+    return (time() + min(answer.rrset.ttl, MAX_TTL),
+            [record.to_text() for record in answer])
+
+
+def _get_local(key: str):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] <= time():
+            del _cache[key]
+            entry = None
+    return entry
+
+
+def _set_local(key: str, entry: tuple):
+    with _cache_lock:
+        if len(_cache) >= MAX_ENTRIES:
+            now = time()
+            for expired in [k for k, v in _cache.items() if v[0] <= now]:
+                del _cache[expired]
+            if len(_cache) >= MAX_ENTRIES:
+                _cache.clear()
+        _cache[key] = entry
+
+
+def _get_shared(key: str):
+    try:
+        redis = get_redis_connection(settings.SCAN_DNS_CACHE_URL)
+        pipe = redis.pipeline()
+        pipe.get(key)
+        pipe.ttl(key)
+        value, ttl = pipe.execute()
+    except RedisError:
+        # the shared cache is optional
+        return None
+    if value is None or ttl is None or ttl <= 0:
+        return None
+    return time() + ttl, json.loads(value.decode())
+
+
+def _set_shared(key: str, entry: tuple):
+    ttl = int(entry[0] - time())
+    if ttl <= 0:
+        return
+    try:
+        redis = get_redis_connection(settings.SCAN_DNS_CACHE_URL)
+        redis.set(key, json.dumps(entry[1]), ex=ttl)
+    except RedisError:
+        # the shared cache is optional
+        pass
@@ -10,6 +10,13 @@ A test must declare a test_dependencies list containing the test_name of all
 tests that need to be run before the test itself (and thus the results of that
 tests are provided within the previous_results dictionary).
 If a test does not have dependencies, an empty list should be supplied.
+
+Optionally, a test can declare the resources it occupies on the scan host
+while running as test_resources, a dictionary mapping resource names to the
+number of required tokens, e.g. {'browser': 1}. The number of tokens
+available per host is configured in the SCAN_HOST_RESOURCES setting; tests
+requiring a resource listed in SCAN_RESOURCE_QUEUES are routed to the
+respective queue.
 """
 # Copyright (C) 2017 PrivacyScore Contributors
 # 
@@ -31,6 +38,9 @@ from typing import Dict, Union
 
 test_name = 'example'
 test_dependencies = ['another_example', 'foobar']
+test_resources = {
+    'cpu': 2,
+}
 
 
 def test_site(url: str, previous_results: dict, **options) -> Dict[str, Dict[str, Union[str, bytes]]]:
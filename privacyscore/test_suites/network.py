@@ -3,27 +3,34 @@ This test module does a number of network-based checks to determine web- and mai
 addresses and the final URL after following any HTTP forwards.
 """
 
+import heapq
 import json
 import re
 import traceback
-from typing import Dict, List, Union
+from collections import OrderedDict
+from hashlib import md5
+from concurrent.futures import Future, ThreadPoolExecutor, \
+    TimeoutError as FutureTimeoutError
+from threading import Lock, local
+from time import time
+from typing import Dict, List, Tuple, Union
 from urllib.parse import urlparse
-import subprocess
 import os
 
 import requests
-from dns import resolver, reversename
+from requests.cookies import RequestsCookieJar
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from dns import reversename
 from dns.exception import DNSException
-from geoip2.database import Reader
+from geoip2.database import MODE_MMAP, Reader
 from geoip2.errors import AddressNotFoundError
 
+from privacyscore.test_suites.dnscache.common import query
+
 
 test_name = 'network'
 test_dependencies = []
 
-# TODO put the path somewhere else, maybe in settings
-HSTS_FILE = "/opt/privacyscore/.wget-hsts"
-
 # The minimum Jaccard coefficient required for the
 # comparison of http and https version of a site
 # so that we accept both sites to show the same
@@ -31,88 +38,90 @@ HSTS_FILE = "/opt/privacyscore/.wget-hsts"
 # that the scanned site is not available via https)
 MINIMUM_SIMILARITY = 0.90
 
-def retrieve_url_with_wget(url):
-    """calls wget and extracts the final url and the http body from the response
-       IndexError or subprocess.CalledProcessError will be thrown if site is unreachable
-    """
-    
-    # TODO this is hacky, but necessary, because (only) on some of our scan hosts
-    # we have a wget version that implements hsts. Once all VMs are upgraded, we can
-    # use the --no-hsts parameter of wget
-    if os.path.isfile(HSTS_FILE):
-        os.remove(HSTS_FILE)
-    
-    # this needs python 3.5, but some of our VMs still have Python 3.4
-    #proc = subprocess.run(['wget', '--no-verbose', url, '-O-', '--no-check-certificate',
-    #                      '--user-agent="Mozilla/5.0 (X11; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0"'],
-    #                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-    cmd = ['env', 'LC_ALL=C', 'wget', '--no-verbose', url, '-O-', \
-           '--no-check-certificate',
-           '--user-agent="Mozilla/5.0 (X11; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0"']
-    proc = subprocess.Popen(cmd,
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    try:
-        (stdout, stderr) = proc.communicate(timeout=15)
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        raise
-    
-    # if wget returns 8, this indicates HTTP status != 200
-    http_error = None
-    final_url = None
-    content = None
-
-    if proc.returncode == 8:
-        if re.search('(ERROR .*)', stderr.decode(errors='replace')):
-            http_error = re.search('(ERROR .*)', stderr.decode(errors='replace')).group(1)
-        else:
-            http_error = "Unspecified error."
+# The number of token hashes kept in the content signature of a site. The
+# similarity of pages with fewer distinct tokens is calculated exactly.
+SIGNATURE_SIZE = 512
 
-    # we do error handling this way so that error handling in the caller is already compatible with subprocess.run
-    elif not proc.returncode == 0:
-        raise subprocess.CalledProcessError(proc.returncode, " ".join(cmd))
-    
-    else:
-        # wget output looks like this:
-        # '2017-12-21 10:34:51 URL:https://www.example.com/foo/bar [64407] -> "-" [1]\n'
-        if re.search('URL:([^ ]+)', stderr.decode(errors='replace')):
-            final_url = re.search('URL:([^ ]+)', stderr.decode(errors='replace')).group(1)
-        content = stdout
-    
-    return final_url, content, http_error
-    
+# The number of DNS queries issued concurrently and the time in seconds after
+# which all DNS lookups of a scan are given up. Lookups which have not
+# finished by then are treated as if they returned no records.
+DNS_CONCURRENCY = 10
+DNS_TIMEOUT = 30
 
-def test_site(url: str, previous_results: dict, country_database_path: str) -> Dict[str, Dict[str, Union[str, bytes]]]:
+# The number of geoip lookup results cached per process.
+GEOIP_CACHE_SIZE = 10000
+
+# Settings for retrieving the http and https versions of a site. Content
+# exceeding the maximum size (in bytes) is truncated.
+HTTP_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0'
+HTTP_MAX_REDIRECTS = 20
+HTTP_MAX_CONTENT_SIZE = 10 * 1024 * 1024
+HTTP_TIMEOUT = 15
+
+# certificates are not verified when retrieving sites
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+# http sessions are pooled per thread
+_sessions = local()
+
+
+def retrieve_url(url: str, signature_size: int = SIGNATURE_SIZE) -> Tuple[str, bytes, str, List[int]]:
+    """Follow redirects of url and return the final url, the http body and
+    the content signature of the body (see _ContentSignature).
+
+    For responses with an http error status, only the error is returned.
+    requests.RequestException is raised if the site is unreachable.
+    """
+    deadline = time() + HTTP_TIMEOUT
+    session = _get_session()
+    # Only the connections are reused. Like a single run of wget, cookies
+    # are kept while following redirects, but not across retrievals.
+    session.cookies = RequestsCookieJar()
+    response = session.get(
+        url, stream=True, verify=False, timeout=HTTP_TIMEOUT)
+    with response:
+        if response.status_code >= 400:
+            return None, None, 'ERROR {}: {}.'.format(
+                response.status_code, response.reason), None
+
+        content = bytearray()
+        signature = _ContentSignature(signature_size)
+        for chunk in response.iter_content(chunk_size=65536):
+            chunk = chunk[:HTTP_MAX_CONTENT_SIZE - len(content)]
+            content += chunk
+            signature.update(chunk)
+            if len(content) >= HTTP_MAX_CONTENT_SIZE:
+                break
+            if time() > deadline:
+                raise requests.Timeout(
+                    'Retrieving {} took too long.'.format(url))
+
+    return response.url, bytes(content), None, signature.finish()
+
+
+def _get_session() -> requests.Session:
+    """Get the http session of the current thread."""
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.headers['User-Agent'] = HTTP_USER_AGENT
+        session.max_redirects = HTTP_MAX_REDIRECTS
+        _sessions.session = session
+    return session
+
+
+def test_site(url: str, previous_results: dict, country_database_path: str,
+              signature_size: int = SIGNATURE_SIZE) -> Dict[str, Dict[str, Union[str, bytes]]]:
     """Test the specified url with geoip."""
     result = {}
     general_result = {}
+    signatures = {}
 
     # determine hostname
     hostname = urlparse(url).hostname
 
     # DNS
-    # cname records
-    general_result['cname_records'] = _cname_lookup(hostname)
-
-    # a records
-    general_result['a_records'] = _a_lookup(hostname)
-
-    # mx records
-    general_result['mx_records'] = _mx_lookup(hostname)
-    if hostname.startswith('www.'):
-        general_result['mx_records'] += _mx_lookup(hostname[4:])
-
-    # mx a-records
-    general_result['mx_a_records'] = [(pref, _a_lookup(mx)) for pref, mx in general_result['mx_records']]
-
-    # reverse a
-    general_result['a_records_reverse'] = [_reverse_lookup(a) for a in general_result['a_records']]
-
-    # reverse mx-a
-    general_result['mx_a_records_reverse'] = [
-        (pref,
-         [_reverse_lookup(a) for a in mx_a])
-        for pref, mx_a in general_result['mx_a_records']]
+    general_result.update(_dns_lookups(hostname))
 
     general_result['reachable'] = True
     
@@ -121,21 +130,33 @@ def test_site(url: str, previous_results: dict, country_database_path: str) -> D
         general_result['reachable'] = False
 
     else:
+        # retrieve the https version concurrently (unless the url already is
+        # the https version), it is needed unless we are redirected there
+        https_url = 'https:/' + url.split('/', maxsplit=1)[1]
+        executor = ThreadPoolExecutor(max_workers=1)
+        https_future = None
+        if https_url != url:
+            https_future = executor.submit(
+                retrieve_url, https_url, signature_size)
+        executor.shutdown(wait=False)
+
         # determine final url
         try:
-            wget_final_url, wget_content, http_error = retrieve_url_with_wget(url)
+            final_url, content, http_error, signature = retrieve_url(
+                url, signature_size)
             if http_error:
                 general_result['http_error'] = http_error
                 general_result['final_url'] = url # so that we can check the https version below
             else:
-                general_result['final_url'] = wget_final_url
+                general_result['final_url'] = final_url
                 result['final_url_content'] = {
                     'mime_type': 'text/html', # probably not always correct, leaving that for later ...
-                    'data': wget_content,
+                    'data': content,
                 }
+                signatures['final_url'] = signature
         
-        # if subprocess.run failed OR re.search did not find anything suitable: raise an exception!
-        except (IndexError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        # the site is unreachable: raise an exception!
+        except requests.RequestException:
             # TODO: extend api to support registration of partial errors
             general_result['unreachable_exception'] = traceback.format_exc()
             general_result['final_url'] = url
@@ -148,25 +169,34 @@ def test_site(url: str, previous_results: dict, country_database_path: str) -> D
 
         # now let's check the https version again (unless we already have been redirected there)
         if not general_result['final_url'].startswith('https'):
-            https_url = 'https:/' + url.split('/', maxsplit=1)[1]
             try:
-                
-                wget_final_url, wget_content, https_error = retrieve_url_with_wget(https_url)
+                if https_future is not None:
+                    final_url, content, https_error, signature = \
+                        https_future.result()
+                else:
+                    final_url, content, https_error, signature = \
+                        retrieve_url(https_url, signature_size)
                 
                 if https_error:
                     general_result['https_error'] = https_error
                     general_result['final_https_url'] = https_url 
                 else:
-                    general_result['final_https_url'] = wget_final_url
+                    general_result['final_https_url'] = final_url
                     result['final_https_url_content'] = {
                         'mime_type': 'text/html', # probably not always correct, leaving that for later ...
-                        'data': wget_content,
+                        'data': content,
                     }
-            except (IndexError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                    signatures['final_https_url'] = signature
+            except requests.RequestException:
                 general_result['final_https_url'] = False
         else:
             general_result['final_https_url'] = general_result['final_url']
 
+    if signatures:
+        result['content_signatures'] = {
+            'mime_type': 'application/json',
+            'data': json.dumps(signatures).encode(),
+        }
 
     result['general'] = {
         'mime_type': 'application/json',
@@ -175,12 +205,13 @@ def test_site(url: str, previous_results: dict, country_database_path: str) -> D
     return result
 
 
-def process_test_data(raw_data: list, previous_results: dict, country_database_path: str) -> Dict[str, Dict[str, object]]:
+def process_test_data(raw_data: list, previous_results: dict, country_database_path: str,
+                      signature_size: int = SIGNATURE_SIZE) -> Dict[str, Dict[str, object]]:
     """Process the raw data of the test."""
     result = json.loads(raw_data['general']['data'].decode())
 
     # geoip
-    reader = Reader(country_database_path)
+    reader = _CountryReader.get(country_database_path)
 
     result['a_locations'] = _get_countries(result['a_records'], reader)
     result['mx_locations'] = _get_countries(
@@ -195,24 +226,91 @@ def process_test_data(raw_data: list, previous_results: dict, country_database_p
     if (not result['final_url_is_https'] and
             'final_url_content' in raw_data and
             'final_https_url_content' in raw_data):
-        similarity = _jaccard_index(
-            raw_data['final_url_content']['data'],
-            raw_data['final_https_url_content']['data'])
+        signatures = {}
+        if 'content_signatures' in raw_data:
+            signatures = json.loads(
+                raw_data['content_signatures']['data'].decode())
+        if 'final_url' in signatures and 'final_https_url' in signatures:
+            similarity = _signature_similarity(
+                signatures['final_url'], signatures['final_https_url'],
+                signature_size)
+        else:
+            # raw data of scans before content signatures were introduced
+            similarity = _jaccard_index(
+                raw_data['final_url_content']['data'],
+                raw_data['final_https_url_content']['data'])
         result['same_content_via_https'] = similarity > MINIMUM_SIMILARITY
 
     return result
 
 
+def _dns_lookups(hostname: str) -> dict:
+    """Perform all DNS lookups for hostname concurrently."""
+    deadline = time() + DNS_TIMEOUT
+
+    def _result(future: Future) -> list:
+        try:
+            return future.result(timeout=max(0, deadline - time()))
+        except FutureTimeoutError:
+            return []
+
+    result = {}
+    executor = ThreadPoolExecutor(max_workers=DNS_CONCURRENCY)
+    try:
+        cname_future = executor.submit(_cname_lookup, hostname)
+        a_future = executor.submit(_a_lookup, hostname)
+        mx_futures = [executor.submit(_mx_lookup, hostname)]
+        if hostname.startswith('www.'):
+            mx_futures.append(executor.submit(_mx_lookup, hostname[4:]))
+
+        # cname records
+        result['cname_records'] = _result(cname_future)
+
+        # a records
+        result['a_records'] = _result(a_future)
+        a_reverse_futures = [
+            executor.submit(_reverse_lookup, a) for a in result['a_records']]
+
+        # mx records
+        result['mx_records'] = []
+        for future in mx_futures:
+            result['mx_records'] += _result(future)
+
+        # mx a-records
+        mx_a_futures = [
+            (pref, executor.submit(_a_lookup, mx))
+            for pref, mx in result['mx_records']]
+        result['mx_a_records'] = [
+            (pref, _result(future)) for pref, future in mx_a_futures]
+        mx_a_reverse_futures = [
+            (pref, [executor.submit(_reverse_lookup, a) for a in mx_a])
+            for pref, mx_a in result['mx_a_records']]
+
+        # reverse a
+        result['a_records_reverse'] = [
+            _result(future) for future in a_reverse_futures]
+
+        # reverse mx-a
+        result['mx_a_records_reverse'] = [
+            (pref, [_result(future) for future in futures])
+            for pref, futures in mx_a_reverse_futures]
+    finally:
+        # do not wait for lookups which exceeded the deadline
+        executor.shutdown(wait=False)
+
+    return result
+
+
 def _a_lookup(name: str) -> List[str]:
     try:
-        return [e.address for e in resolver.query(name, 'A')]
+        return [e.address for e in query(name, 'A')]
     except DNSException:
         return []
 
 
 def _cname_lookup(name: str) -> List[str]:
     try:
-        return [e.to_text()[:-1].lower() for e in resolver.query(name, 'CNAME')]
+        return [e.to_text()[:-1].lower() for e in query(name, 'CNAME')]
     except DNSException:
         return []
 
@@ -220,7 +318,7 @@ def _cname_lookup(name: str) -> List[str]:
 def _mx_lookup(name: str) -> List[str]:
     try:
         return sorted([(e.preference, e.exchange.to_text()[:-1].lower())
-                       for e in resolver.query(name, 'MX')], key=lambda v: v[0])
+                       for e in query(name, 'MX')], key=lambda v: v[0])
     except DNSException:
         return []
 
@@ -229,26 +327,75 @@ def _reverse_lookup(ip: str) -> List[str]:
     try:
         address = reversename.from_address(ip).to_text()
         return [rev.to_text()[:-1].lower()
-                for rev in resolver.query(address, 'PTR')]
+                for rev in query(address, 'PTR')]
     except DNSException:
         return []
 
 
-def _get_countries(addresses: List[str], reader: Reader) -> List[str]:
-    res = set()
-    for ip in addresses:
+class _CountryReader:
+    """
+    Memory-mapped geoip country database shared by the process.
+
+    Lookup results are kept in an LRU cache. The database is reopened when
+    the file changes on disk.
+    """
+    _readers = {}
+    _readers_lock = Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        self._reader = None
+        self._mtime = None
+        self._cache = OrderedDict()
+
+    @classmethod
+    def get(cls, path: str) -> '_CountryReader':
+        """Get the reader for the database at path."""
+        with cls._readers_lock:
+            if path not in cls._readers:
+                cls._readers[path] = cls(path)
+            return cls._readers[path]
+
+    def countries(self, ips: List[str]) -> List[Union[str, None]]:
+        """
+        Look up the country (or continent, if the country is unknown) of
+        each ip. None is returned for addresses which are not found.
+        """
+        with self._lock:
+            self._open()
+            return [self._country(ip) for ip in ips]
+
+    def _open(self):
+        mtime = os.stat(self.path).st_mtime
+        if self._reader is not None and mtime == self._mtime:
+            return
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = Reader(self.path, mode=MODE_MMAP)
+        self._mtime = mtime
+        self._cache.clear()
+
+    def _country(self, ip: str) -> Union[str, None]:
+        if ip in self._cache:
+            self._cache.move_to_end(ip)
+            return self._cache[ip]
         try:
-            geoip_result = reader.country(ip)
-            this_result = geoip_result.country.name
-            if not this_result:
-                this_result = geoip_result.continent.name
-            if not this_result:
-                raise AddressNotFoundError
-            res.add(this_result)
+            geoip_result = self._reader.country(ip)
+            country = (geoip_result.country.name or
+                       geoip_result.continent.name or None)
         except AddressNotFoundError:
-            # TODO: Add entry specifying that at least one location has not been found
-            continue
-    return list(res)
+            country = None
+        self._cache[ip] = country
+        if len(self._cache) > GEOIP_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return country
+
+
+def _get_countries(addresses: List[str], reader: _CountryReader) -> List[str]:
+    # TODO: Add entry specifying that at least one location has not been found
+    return list({country for country in reader.countries(list(addresses))
+                 if country})
 
 
 def _jaccard_index(a: bytes, b: bytes) -> float:
@@ -261,3 +408,63 @@ def _jaccard_index(a: bytes, b: bytes) -> float:
     intersection = a.intersection(b)
     union = a.union(b)
     return len(intersection) / len(union)
+
+
+class _ContentSignature:
+    """
+    Bottom-k signature of the tokens of a page.
+
+    The page is split into tokens the same way as by _jaccard_index. The
+    signature consists of the size smallest hashes of the distinct tokens
+    and is calculated incrementally while the page is retrieved.
+    """
+    _pattern = re.compile(rb' |\n')
+
+    def __init__(self, size: int):
+        self.size = size
+        self._heap = []  # negated hashes, the largest hash is on top
+        self._hashes = set()
+        self._tail = b''
+
+    def update(self, data: bytes):
+        """Add a chunk of the page."""
+        tokens = self._pattern.split(self._tail + data)
+        # the last token may continue in the next chunk
+        self._tail = tokens.pop()
+        for token in tokens:
+            self._add(token)
+
+    def finish(self) -> List[int]:
+        """Return the signature of the page."""
+        self._add(self._tail)
+        self._tail = b''
+        return sorted(self._hashes)
+
+    def _add(self, token: bytes):
+        # remove tokens containing / to prevent wrong classifications for
+        # absolute paths
+        if b'/' in token:
+            return
+        value = int.from_bytes(md5(token).digest()[:8], 'big')
+        if value in self._hashes:
+            return
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, -value)
+            self._hashes.add(value)
+        elif value < -self._heap[0]:
+            self._hashes.remove(-heapq.heappushpop(self._heap, -value))
+            self._hashes.add(value)
+
+
+def _signature_similarity(a: List[int], b: List[int], size: int) -> float:
+    """Estimate the jaccard similarity of two pages from their signatures."""
+    a = set(a)
+    b = set(b)
+    if len(a) < size and len(b) < size:
+        # the signatures contain all tokens of both pages
+        union = a.union(b)
+    else:
+        union = set(sorted(a.union(b))[:size])
+    if not union:
+        return 0
+    return len(union.intersection(a, b)) / len(union)
@@ -2,41 +2,66 @@
 Check the website for privacy issues like cookies, 3rd parties, etc, using OpenWPM.
 """
 
+import hashlib
 import json
 import os
+import pickle
 import re
 import shutil
+import socket
 import sqlite3
 import sys
 import tempfile
 import timeit
 import traceback
 
+from collections import OrderedDict
+from contextlib import closing
 from io import BytesIO
-from subprocess import call, DEVNULL
+from subprocess import DEVNULL
 from time import time
 from typing import Dict, Union
 from uuid import uuid4
-from adblockparser import AdblockRules
-
-import tldextract
+from adblockparser import AdblockRule, AdblockRules
 
 from django.conf import settings
 from PIL import Image
 
+from privacyscore.utils import extract_domain, supervised_call
+
 
 test_name = 'openwpm'
 test_dependencies = [
     'network',
 ]
+test_resources = {
+    'browser': 1,
+}
 
 
 OPENWPM_WRAPPER_PATH = os.path.join(
     settings.SCAN_TEST_BASEPATH, 'openwpm_wrapper.py')
 
+EASYLIST_PATHS = [
+    os.path.join(settings.SCAN_TEST_BASEPATH, 'vendor/EasyList', name)
+    for name in ('easylist.txt', 'easyprivacy.txt', 'fanboy-annoyance.txt')]
+EASYLIST_CACHE_PATH = os.path.join(
+    settings.SCAN_TEST_BASEPATH, 'vendor/EasyList', 'rules.pickle')
+
+# The compiled tracker rules of the process and the modification times of
+# the lists they have been compiled from.
+_tracker_rules = None
+
+
+def test_site(url: str, previous_results: dict, scan_basedir: str, virtualenv_path: str,
+              daemon_socket: str = None) -> Dict[str, Dict[str, Union[str, bytes]]]:
+    """
+    Test a site using openwpm and related tests.
 
-def test_site(url: str, previous_results: dict, scan_basedir: str, virtualenv_path: str) -> Dict[str, Dict[str, Union[str, bytes]]]:
-    """Test a site using openwpm and related tests."""
+    If the socket of a running openwpm_daemon.py is given, the site is
+    visited by one of its browsers. Otherwise, a new browser is started
+    using openwpm_wrapper.py.
+    """
 
     result = {
         'raw_url': {
@@ -58,64 +83,92 @@ def test_site(url: str, previous_results: dict, scan_basedir: str, virtualenv_pa
     scan_dir = os.path.join(scan_basedir, str(uuid4()))
     os.mkdir(scan_dir)
 
-    call([
-        OPENWPM_WRAPPER_PATH,
-        url,
-        scan_dir,
-    ], stdout=DEVNULL, stderr=DEVNULL,
-         cwd=settings.SCAN_TEST_BASEPATH, env={
-             'VIRTUAL_ENV': virtualenv_path,
-             'PATH': '{}:{}'.format(
-                 os.path.join(virtualenv_path, 'bin'), os.environ.get('PATH')),
-    })
-
-    # collect raw output
-    # log file
-    with open(os.path.join(scan_dir, 'openwpm.log'), 'rb') as f:
-        result['log'] = {
-            'mime_type': 'text/plain',
-            'data': f.read(),
-        }
-
-    # sqlite db
-    with open(os.path.join(scan_dir, 'crawl-data.sqlite3'), 'rb') as f:
-        result['crawldata'] = {
-            'mime_type': 'application/x-sqlite3',
-            'data': f.read(),
-        }
+    try:
+        if not daemon_socket or not _scan_with_daemon(daemon_socket, url, scan_dir):
+            supervised_call([
+                OPENWPM_WRAPPER_PATH,
+                url,
+                scan_dir,
+            ], stdout=DEVNULL, stderr=DEVNULL,
+                 cwd=settings.SCAN_TEST_BASEPATH, env={
+                     'VIRTUAL_ENV': virtualenv_path,
+                     'PATH': '{}:{}'.format(
+                         os.path.join(virtualenv_path, 'bin'), os.environ.get('PATH')),
+            })
 
-    # screenshot
-    if os.path.isfile(os.path.join(scan_dir, 'screenshots/screenshot.png')):
-        with open(os.path.join(scan_dir, 'screenshots/screenshot.png'), 'rb') as f:
-            result['screenshot'] = {
-                'mime_type': 'image/png',
+        # collect raw output
+        # log file
+        with open(os.path.join(scan_dir, 'openwpm.log'), 'rb') as f:
+            result['log'] = {
+                'mime_type': 'text/plain',
                 'data': f.read(),
             }
-    
-    # html source
-    if os.path.isfile(os.path.join(scan_dir, 'sources/source.html')):
-        with open(os.path.join(scan_dir, 'sources/source.html'), 'rb') as f:
-            result['html_source'] = {
-                'mime_type': 'text/html',
+
+        # sqlite db
+        with open(os.path.join(scan_dir, 'crawl-data.sqlite3'), 'rb') as f:
+            result['crawldata'] = {
+                'mime_type': 'application/x-sqlite3',
                 'data': f.read(),
             }
-    
-    # cropped and pixelized screenshot
-    if 'screenshot' in result:
-        out = BytesIO()
-        pixelize_screenshot(BytesIO(result['screenshot']['data']), out)
-        result['cropped_screenshot'] = {
-            'mime_type': 'image/png',
-            'data': out.getvalue(),
-        }
 
-    # recursively delete scan folder
-    shutil.rmtree(scan_dir)
+        # screenshot
+        if os.path.isfile(os.path.join(scan_dir, 'screenshots/screenshot.png')):
+            with open(os.path.join(scan_dir, 'screenshots/screenshot.png'), 'rb') as f:
+                result['screenshot'] = {
+                    'mime_type': 'image/png',
+                    'data': f.read(),
+                }
+    
+        # html source
+        if os.path.isfile(os.path.join(scan_dir, 'sources/source.html')):
+            with open(os.path.join(scan_dir, 'sources/source.html'), 'rb') as f:
+                result['html_source'] = {
+                    'mime_type': 'text/html',
+                    'data': f.read(),
+                }
+    
+        # cropped and pixelized screenshot
+        if 'screenshot' in result:
+            out = BytesIO()
+            pixelize_screenshot(BytesIO(result['screenshot']['data']), out)
+            result['cropped_screenshot'] = {
+                'mime_type': 'image/png',
+                'data': out.getvalue(),
+            }
+    finally:
+        # recursively delete scan folder, also if the daemon did not answer
+        # in time and may still be writing to it
+        shutil.rmtree(scan_dir, ignore_errors=True)
 
     return result
 
 
-def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str, virtualenv_path: str) -> Dict[str, Dict[str, object]]:
+def _scan_with_daemon(daemon_socket: str, url: str, scan_dir: str) -> bool:
+    """
+    Let openwpm_daemon.py visit url and write the results to scan_dir.
+
+    Returns False if the daemon is not running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with closing(sock):
+        sock.settimeout(settings.SCAN_SUITE_TIMEOUT_SECONDS)
+        try:
+            sock.connect(daemon_socket)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+        sock.sendall(json.dumps({
+            'url': url,
+            'scan_dir': scan_dir,
+        }).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            response = f.readline()
+    if not response:
+        raise ConnectionError('openwpm daemon closed the connection')
+    return True
+
+
+def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str, virtualenv_path: str,
+                      daemon_socket: str = None) -> Dict[str, Dict[str, object]]:
     """Process the raw data of the test."""
 
     # TODO: Clean up collection
@@ -138,22 +191,76 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         scantosave['openwpm_skipped_due_to_not_reachable'] = True
         return scantosave
 
-    # store sqlite database in a temporary file
     url = raw_data['raw_url']['data'].decode()
 
-    temp_db_file = tempfile.mktemp()
-    with open(temp_db_file, 'wb') as f:
-        f.write(raw_data['crawldata']['data'])
+    with _open_crawl_database(raw_data['crawldata']['data']) as conn:
+        _process_crawl_database(conn, url, previous_results, scantosave)
 
-    conn = sqlite3.connect(temp_db_file)
-    outercur = conn.cursor()
+    return scantosave
 
-    # requests
-    for start_time, site_url in outercur.execute(
-            "SELECT DISTINCT start_time, site_url " +
+
+def _open_crawl_database(data: bytes):
+    """Open the crawl database, in memory if supported by sqlite3."""
+    conn = sqlite3.connect(':memory:')
+    if hasattr(conn, 'deserialize'):
+        conn.deserialize(data)
+        return closing(conn)
+    conn.close()
+    return _TemporaryDatabase(data)
+
+
+class _TemporaryDatabase:
+    """A database connection to a copy of data in a temporary file."""
+    def __init__(self, data: bytes):
+        self.file = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        self.file.write(data)
+        self.file.flush()
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn = sqlite3.connect(self.file.name)
+        return self.conn
+
+    def __exit__(self, *args):
+        self.conn.close()
+        self.file.close()
+
+
+def _normalize_site(url: str) -> str:
+    """Normalize the url like normalize_site of openwpm_wrapper.py, which is
+    the url stored in the crawl database."""
+    if not url.startswith('http'):
+        url = 'http://' + url
+    if re.search(r"^(https?:\/\/)?[^\/]*$", url, re.IGNORECASE):
+        url = url + '/'
+    return url
+
+
+def _get_visits(conn: sqlite3.Connection, url: str) -> tuple:
+    """
+    Get the visits of the site as a dictionary whose keys are their start
+    times and urls, and the list of their ids.
+    """
+    visits = OrderedDict()
+    visit_ids = []
+    for visit_id, start_time, site_url in conn.execute(
+            "SELECT s.visit_id, start_time, site_url " +
             "FROM crawl as c JOIN site_visits as s " +
-            "ON c.crawl_id = s.crawl_id WHERE site_url LIKE ?;", (url,)):
-        # Get a new cursor to avoid confusing the old one
+            "ON c.crawl_id = s.crawl_id WHERE site_url = ?;",
+            (_normalize_site(url),)):
+        visits[(start_time, site_url)] = None
+        visit_ids.append(visit_id)
+    return visits, visit_ids
+
+
+def _process_crawl_database(conn: sqlite3.Connection, url: str,
+                            previous_results: dict, scantosave: dict):
+    # The visits of the site are determined once. All other tables are
+    # queried by their visit ids.
+    visits, visit_ids = _get_visits(conn, url)
+    visit_filter = 'visit_id IN ({})'.format(', '.join('?' * len(visit_ids)))
+
+    # requests
+    for start_time, site_url in visits:
         cur = conn.cursor()
 
         scantosave['initial_url'] = site_url
@@ -162,7 +269,7 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         # collect third parties (i.e. domains that differ in their second and third level domain
         third_parties = []
         third_party_requests = []
-        extracted_visited_url = tldextract.extract(previous_results.get('final_url'))
+        extracted_visited_url = extract_domain(previous_results.get('final_url'))
         maindomain_visited_url = "{}.{}".format(extracted_visited_url.domain, extracted_visited_url.suffix)
 
         # TODO: the following line results in urls starting with a dot
@@ -170,8 +277,7 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         hostname_visited_url = '.'.join(e for e in extracted_visited_url if e)
 
         for requrl, method, referrer, headers in cur.execute("SELECT url, method, referrer, headers " +
-                "FROM site_visits as s JOIN http_requests as h ON s.visit_id = h.visit_id " +
-                "WHERE s.site_url LIKE ? ORDER BY h.id;", (url,)):  # site["url"]
+                "FROM http_requests WHERE " + visit_filter + " ORDER BY id;", visit_ids):
             scantosave["requests"].append({
                 'url': requrl,
                 'method': method,
@@ -180,7 +286,7 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
             })
 
             # extract domain name from request and check whether it is a 3rd party host
-            extracted = tldextract.extract(requrl)
+            extracted = extract_domain(requrl)
             maindomain = "{}.{}".format(extracted.domain, extracted.suffix)
             hostname = '.'.join(e for e in extracted if e)
             if(maindomain_visited_url != maindomain):
@@ -209,12 +315,36 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         scantosave["google_analytics_anonymizeIP_not_set"] = not_anonymized
 
 
+        # OpenWPM times out after 60 seconds if it cannot reach a site (e.g. due to fail2ban on port 443)
+        # Note that this is not "our" timeout that kills the scan worker, but OpenWPM terminates on its own..
+        # As a result, the final_urls table will not have been created.
+        # In this case redirected_to_https cannot be determined accurately here.
+        # This issue must be handled in the evaluation by looking at 'success', which will be
+        # false if final_urls table is missing.
+        final_url_res = None
+        final_url_exception = None
+        try:
+            # retrieve final URL (after potential redirects) - will throw an exception if final_urls table
+            # does not exist (i.e. OpenWPM timed out due to connectivity problems)
+            cur.execute("SELECT final_url FROM final_urls WHERE original_url = ?;", [site_url]);
+            final_url_res = cur.fetchone()
+        except Exception:
+            final_url_exception = traceback.format_exc()
+        if final_url_exception:
+            matching_url = site_url
+        elif not(final_url_res == None) and len(final_url_res)>0:
+            matching_url = final_url_res[0]
+        else:
+            matching_url = scantosave.get('openwpm_final_url')
+
         # responses
+        # The response of the final url is determined while collecting them
+        matching_response = None
+        backup_response = None
         for respurl, method, referrer, headers, response_status, response_status_text, time_stamp in cur.execute(
                 "SELECT url, method, referrer, headers, response_status, response_status_text, " +
-                "time_stamp FROM site_visits as s JOIN http_responses as h " +
-                "ON s.visit_id = h.visit_id WHERE s.site_url LIKE ? ORDER BY h.id;", (url,)):  # site["url"]
-            scantosave["responses"].append({
+                "time_stamp FROM http_responses WHERE " + visit_filter + " ORDER BY id;", visit_ids):
+            resp = {
                 'url': respurl,
                 'method': method,
                 'referrer': referrer,
@@ -222,7 +352,13 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
                 'response_status': response_status,
                 'response_status_text': response_status_text,
                 'time_stamp': time_stamp
-            })
+            }
+            scantosave["responses"].append(resp)
+            if matching_response is None and respurl == matching_url:
+                matching_response = resp
+            if backup_response is None and (
+                    response_status < 300 or response_status > 399):
+                backup_response = resp
 
 
         # if there are no responses the site failed to load
@@ -239,17 +375,10 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
                 scantosave["https"] = True
 
 
-            # OpenWPM times out after 60 seconds if it cannot reach a site (e.g. due to fail2ban on port 443)
-            # Note that this is not "our" timeout that kills the scan worker, but OpenWPM terminates on its own..
-            # As a result, the final_urls table will not have been created.
-            # In this case redirected_to_https cannot be determined accurately here.
-            # This issue must be handled in the evaluation by looking at 'success', which will be
-            # false if final_urls table is missing.
             try:
-                # retrieve final URL (after potential redirects) - will throw an exception if final_urls table
-                # does not exist (i.e. OpenWPM timed out due to connectivity problems)
-                cur.execute("SELECT final_url FROM final_urls WHERE original_url = ?;", [site_url]);
-                res = cur.fetchone()
+                if final_url_exception:
+                    raise Exception(final_url_exception)
+                res = final_url_res
                 openwpm_final_url = ""
                 if(not(res == None) and len(res)>0):
                     openwpm_final_url = res[0]
@@ -269,7 +398,7 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
                     scantosave["redirected_to_https"] = True
 
             except Exception:
-                scantosave["exception"] = traceback.format_exc()
+                scantosave["exception"] = final_url_exception or traceback.format_exc()
                 scantosave["redirected_to_https"] = False
                 scantosave["https"] = False
                 scantosave["success"] = False
@@ -279,14 +408,12 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
             # Iterate through responses in order until we have arrived at the openwpm_final_url
             # (i.e. the URL of the website after all redirects), as this is the one whose headers we want.
             
-            response = find_matching_response(scantosave["openwpm_final_url"], scantosave["responses"])
+            # (the response has been determined while collecting the responses)
+            response = matching_response
             # Javascript Hipster websites may have failed to find any matching request at this point.
             # Backup solution to find at least some matching request.
             if not response:
-                for resp in scantosave["responses"]:
-                    if resp["response_status"] < 300 or resp["response_status"] > 399:
-                        response = resp
-                        break
+                response = backup_response
             # Now we should finally have a response. Verify.
             assert response
 
@@ -358,8 +485,7 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         for baseDomain, name, value, host, path, expiry, accessed, creationTime, isSecure, isHttpOnly in cur.execute(
                 "SELECT baseDomain, name, value, host, path, expiry, " +
                 "accessed, creationTime, isSecure, isHttpOnly " +
-                "FROM site_visits as s JOIN profile_cookies as c " +
-                "ON s.visit_id = c.visit_id WHERE s.site_url LIKE ?;", (url,)):  # site["url"]
+                "FROM profile_cookies WHERE " + visit_filter + ";", visit_ids):
             profilecookie = {
                 'baseDomain': baseDomain,
                 'name': name,
@@ -377,8 +503,7 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         # Flash-Cookies
         for domain, filename, local_path, key, content in cur.execute(
                 "SELECT domain, filename, local_path, key, content " +
-                "FROM site_visits as s JOIN flash_cookies as c " +
-                "ON s.visit_id = c.visit_id WHERE s.site_url LIKE ?;", (url,)):  # site["url"]
+                "FROM flash_cookies WHERE " + visit_filter + ";", visit_ids):
             flashcookie = {
                 'domain': domain,
                 'filename': filename,
@@ -400,27 +525,6 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         if mixed_content is not None:
             scantosave["mixed_content"] = mixed_content
 
-    # Close SQLite connection
-    conn.close()
-
-    # Delete temporary sqlite db file
-    os.remove(temp_db_file)
-
-    return scantosave
-
-
-def find_matching_response(url, responses):
-    """
-    Find a response that matches the provided URL
-
-    :param url: The URL to look for
-    :param responses: A List of responses
-    """
-    for resp in responses:
-        if resp["url"] == url:
-            return resp
-    return None
-
 
 def pixelize_screenshot(screenshot, screenshot_pixelized, target_width=390, pixelsize=3):
     """
@@ -458,6 +562,159 @@ def detect_trackers(third_parties):
     if len(third_parties) == 0:
         return []
 
+    matcher = get_tracker_rules()
+
+    result = set()
+    checked = set()
+    domain_cache = {}
+    for url in third_parties:
+        if url in checked:
+            continue
+        checked.add(url)
+        ext = extract_domain(url)
+        domain = "{}.{}".format(ext.domain, ext.suffix)
+        if domain in result:
+            # further requests to a tracker do not change the result
+            continue
+        if matcher.should_block(url, domain_cache):
+            result.add(domain)
+
+    return list(result)
+
+
+class TrackerMatcher:
+    """
+    Matcher for tracker rules giving the same results as AdblockRules.
+
+    Rules of the form ||domain^ are looked up by the hostname of a request
+    in a set of domains. Only the remaining rules are matched by
+    AdblockRules.
+    """
+    _domain_rule = re.compile(
+        r'^\|\|([a-z0-9-]+(?:\.[a-z0-9-]+)*)\^$', re.IGNORECASE)
+    # The positions at which a ||domain^ rule can match follow the
+    # translation of the rule into a regular expression by adblockparser.
+    _scheme = re.compile(r'^[^:/?#]+:')
+    _authority = re.compile(r'^(?:[^:/?#]+:)?//([^/?#]*)')
+    # the characters not matched by the separator ^
+    _label = re.compile(r'[\w\-.%]*')
+
+    def __init__(self, domains: set, rules: list):
+        """
+        Create a matcher from the data returned by parse.
+
+        Only the combined regular expression of the rules is compiled here,
+        the rules themselves are not parsed again.
+        """
+        self.domains = domains
+        self.rules = AdblockRules(rules)
+
+    @classmethod
+    def parse(cls, rules: list) -> tuple:
+        """
+        Parse the rules into the set of domains of the ||domain^ rules and
+        the list of the remaining rules as AdblockRule instances.
+        """
+        domains = set()
+        other_rules = []
+        for rule in rules:
+            match = cls._domain_rule.match(rule.strip())
+            if match:
+                domains.add(match.group(1).lower())
+            else:
+                other_rules.append(AdblockRule(rule))
+        return domains, other_rules
+
+    def should_block(self, url: str, domain_cache: dict = None) -> bool:
+        """
+        Check whether a request to url is blocked.
+
+        domain_cache may be passed to share the results of the lookups in
+        the domain set between requests to the same host.
+        """
+        return self._matches_domain(url, domain_cache) or \
+            self.rules.should_block(url)
+
+    def _matches_domain(self, url: str, domain_cache: dict = None) -> bool:
+        starts = [0]
+        match = self._scheme.match(url)
+        if match:
+            starts.append(match.end())
+        end = 0
+        match = self._authority.match(url)
+        if match:
+            end = match.end()
+            starts.append(match.start(1))
+            starts.extend(
+                match.start(1) + i + 1
+                for i, char in enumerate(match.group(1)) if char == '.')
+
+        # the result only depends on the part of the url up to the host
+        key = url[:end] if end else url
+        if domain_cache is not None and key in domain_cache:
+            return domain_cache[key]
+        result = any(
+            self._label.match(url, start).group().lower() in self.domains
+            for start in starts)
+        if domain_cache is not None:
+            domain_cache[key] = result
+        return result
+
+
+def get_tracker_rules() -> TrackerMatcher:
+    """
+    Get the compiled tracker rules of the process.
+
+    The rules are compiled once per process and recompiled when one of the
+    lists changes. Parsed rules are also stored in EASYLIST_CACHE_PATH to
+    be reused by other processes as long as the lists do not change.
+    """
+    global _tracker_rules
+    mtimes = tuple(os.stat(path).st_mtime for path in EASYLIST_PATHS)
+    if _tracker_rules is None or _tracker_rules[0] != mtimes:
+        _tracker_rules = mtimes, _load_tracker_rules()
+    return _tracker_rules[1]
+
+
+def _load_tracker_rules() -> TrackerMatcher:
+    digest = hashlib.sha256()
+    for path in EASYLIST_PATHS:
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    digest = digest.digest()
+
+    # The parsed rules are cached instead of the matcher, as unpickling
+    # AdblockRules would compile its regular expressions anyway.
+    try:
+        with open(EASYLIST_CACHE_PATH, 'rb') as f:
+            cached_digest, domains, rules = pickle.load(f)
+        if cached_digest == digest and isinstance(domains, set) and \
+                all(isinstance(rule, AdblockRule) for rule in rules):
+            return TrackerMatcher(domains, rules)
+    except (OSError, EOFError, ValueError, TypeError, AttributeError,
+            ImportError, pickle.UnpicklingError):
+        # no (usable) cache
+        pass
+
+    domains, rules = TrackerMatcher.parse(_read_tracker_rules())
+
+    temp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(EASYLIST_CACHE_PATH), delete=False) as f:
+            temp_path = f.name
+            pickle.dump((digest, domains, rules), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, EASYLIST_CACHE_PATH)
+    except (OSError, pickle.PicklingError, AttributeError, TypeError):
+        # the cache is optional
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return TrackerMatcher(domains, rules)
+
+
+def _read_tracker_rules() -> list:
+    """Read the lists and return the rules used for tracker detection."""
     blacklist = [re.compile('^[\|]*http[s]*[:/]*$'),  # match http[s]:// in all variations
                  re.compile('^[\|]*ws[:/]*$'),  # match ws:// in all variations
                  re.compile('^\.'),  # match rules like .com
@@ -475,54 +732,14 @@ def detect_trackers(third_parties):
                 return False
         return True
 
-    lines = []
     rules = []
-    result = []
-    
-    start_time = timeit.default_timer()
-    
-    # Generate paths to files
-    easylist_path = os.path.join(
-        settings.SCAN_TEST_BASEPATH, 'vendor/EasyList', 'easylist.txt')
-    easyprivacy_path = os.path.join(
-        settings.SCAN_TEST_BASEPATH, 'vendor/EasyList', 'easyprivacy.txt')
-    fanboy_path = os.path.join(
-        settings.SCAN_TEST_BASEPATH, 'vendor/EasyList', 'fanboy-annoyance.txt')
-
-    # Read in files:
-    for line in open(easylist_path, 'r', encoding="utf-8"):
-        lines.append(line)
-    for line in open(easyprivacy_path, 'r', encoding="utf-8"):
-        lines.append(line)
-    for line in open(fanboy_path, 'r', encoding="utf-8"):
-        lines.append(line)
-
-    # Clean up lines:
-    for line in lines:
-        try:
-            rule = line.split('$')[0]
-            if is_acceptable_rule(rule):
-                rules.append(rule)
-        except:
-            print("Unexpected error:", sys.exc_info()[0])
-
-    abr = AdblockRules(rules)
-    
-    elapsed = timeit.default_timer() - start_time
-    print("Elapsed: %i secs" % elapsed)
-    
-    i = 0
-    
-    for url in third_parties:
-        if abr.should_block(url):
-            ext = tldextract.extract(url)
-            result.append("{}.{}".format(ext.domain, ext.suffix))
-        i = i + 1
-        if i % 20 == 0:
-            elapsed = timeit.default_timer() - start_time
-            print("Checked %i domains, %i secs elapsed..." % (i, elapsed))
-
-    return list(set(result))
+    for path in EASYLIST_PATHS:
+        with open(path, 'r', encoding="utf-8") as f:
+            for line in f:
+                rule = line.split('$')[0]
+                if is_acceptable_rule(rule):
+                    rules.append(rule)
+    return rules
 
 
 def detect_google_analytics(requests):
@@ -568,7 +785,7 @@ def detect_mixed_content(url, https, cursor):
     rv = False
     try:
         # Attempt to load all log entries from the database
-        entries = cursor.execute("SELECT log_json FROM browser_logs WHERE original_url LIKE ?;", (url, ))
+        entries = cursor.execute("SELECT log_json FROM browser_logs WHERE original_url = ?;", (_normalize_site(url), ))
         # If we get here, the table existed, so mixed content detection should work
         exp = re.compile("mixed .* content \"(.*)\"")
         for entry in entries:
@@ -602,13 +819,13 @@ def detect_cookies(domain, cookies, flashcookies, trackers):
     tp_track      = 0  # Third party cookies from known trackers
     tp_track_uniq = 0  # Number of unique tracking domains that set cookies
     
-    dom_ext = tldextract.extract(domain)
+    dom_ext = extract_domain(domain)
     seen_trackers = []
 
     for cookie in cookies:
         fp = None
 
-        cd_ext = tldextract.extract(cookie["baseDomain"])
+        cd_ext = extract_domain(cookie["baseDomain"])
         if cd_ext.domain == dom_ext.domain and cd_ext.suffix == dom_ext.suffix:
             fp = True
         else:
@@ -631,7 +848,7 @@ def detect_cookies(domain, cookies, flashcookies, trackers):
                 tp_short += 1
 
     for cookie in flashcookies:
-        cd_ext = tldextract.extract(cookie["domain"])
+        cd_ext = extract_domain(cookie["domain"])
         if cd_ext.domain == dom_ext.domain and cd_ext.suffix == dom_ext.suffix:
             fp_fc += 1
         else:
@@ -2,128 +2,142 @@
 Test for common server leaks.
 """
 import json
+import os
 import re
-from typing import Dict, Union
+from string import Formatter
+from typing import Dict, List, Tuple, Union
 from urllib.parse import urlparse
-from tldextract import extract
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 from requests.models import Response
 from concurrent.futures import ThreadPoolExecutor
 
+from privacyscore.utils import extract_domain
+
 
 test_name = 'serverleak'
 test_dependencies = []
 
+# we store only the top of the file because core dumps can become very large
+# also: we do not want to store more potentially sensitive data than necessary
+# to determine whether there is a leak or not
+MAX_CONTENT_SIZE = 50 * 1024
+
+
+# The trials are loaded from a json file containing a list of objects with
+# the keys
+# - path: The path requested from the site. It may contain the placeholders
+#   {domain}, {subdomain} and {hostname} (e.g. www.example.com for
+#   https://www.example.com/). Trials using {subdomain} are skipped for sites
+#   without subdomain.
+# - match: A string or a list of strings. The site leaks if the response
+#   contains any of them.
+# - regex: A regular expression. The site leaks if it is found in the
+#   response.
+DEFAULT_TRIALS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'serverleak_trials.json')
+
+
+class _Trials:
+    """
+    The trials loaded from a file together with a matcher which finds the
+    strings of all trials in a single pass over a response.
+    """
+    def __init__(self, path: str):
+        with open(path) as f:
+            trials = json.load(f)
+
+        self.trials = []
+        strings = set()
+        for trial in trials:
+            match = trial.get('match', [])
+            if isinstance(match, str):
+                match = [match]
+            regex = re.compile(trial['regex']) if 'regex' in trial else None
+            fields = {name for _, name, _, _ in Formatter().parse(trial['path'])
+                      if name}
+            self.trials.append((trial['path'], fields, frozenset(match), regex))
+            strings.update(match)
+
+        # Searching at every position for the longest string starting there
+        # finds all strings except those contained in a longer string found
+        # at the same position, so these are added afterwards.
+        self._strings = None
+        if strings:
+            self._strings = re.compile('(?=({}))'.format('|'.join(
+                re.escape(string)
+                for string in sorted(strings, key=len, reverse=True))))
+        self._contained = {
+            string: {other for other in strings if other in string}
+            for string in strings}
+
+    def plan(self, url: str) -> List[Tuple[str, int]]:
+        """Determine the trial paths for url together with the index of
+        their trial."""
+        if url is None:
+            # only trials without placeholders can be matched
+            return [(path, i) for i, (path, fields, _, _) in enumerate(self.trials)
+                    if not fields]
+        url_extract = extract_domain(url)
+        hostname = url_extract.domain + '.' + url_extract.suffix
+        if url_extract.subdomain:
+            hostname = url_extract.subdomain + '.' + hostname
+        values = {
+            'domain': url_extract.domain,
+            'subdomain': url_extract.subdomain or None,
+            'hostname': hostname,
+        }
+        plan = []
+        for i, (path, fields, _, _) in enumerate(self.trials):
+            if any(values.get(field) is None for field in fields):
+                continue
+            plan.append((path.format(**values), i))
+        return plan
 
-def _match_db_dump(content):
-    targets = ["SQLite", "CREATE TABLE", "INSERT INTO", "DROP TABLE"]
-    matched = False
-    for target in targets:
-        matched |= target in content
-    return matched
+    def is_leak(self, trial: int, text: str) -> bool:
+        """Check whether text is a leak for the trial with the given index."""
+        _, _, match, regex = self.trials[trial]
+        if regex is not None and regex.search(text):
+            return True
+        return bool(match) and not match.isdisjoint(self.find_strings(text))
 
-def _concat_sub(url, suffix):
-    url_extract = extract(url)
-    if url_extract.subdomain == "":
-        return None
-    site = url_extract.subdomain + "." + url_extract.domain
-    return site + suffix
-
-def _concat_full(url, suffix):
-    url_extract = extract(url)
-    site = url_extract.domain + "." + url_extract.suffix
-    if url_extract.subdomain != "":
-        site = url_extract.subdomain + "." + site
-    return site + suffix
-
-def _gen_db_domain_sql(url):
-    return extract(url).domain + ".sql"
-
-def _gen_db_sub_domain_sql(url):
-    return _concat_sub(url, ".sql")
-
-def _gen_db_full_domain_sql(url):
-    return _concat_full(url, ".sql")
-
-def _gen_db_domain_db(url):
-    return extract(url).domain + ".db"
-
-def _gen_db_sub_domain_db(url):
-    return _concat_sub(url, ".db")
-
-def _gen_db_full_domain_db(url):
-    return _concat_full(url, ".db")
-
-def _gen_db_domain_key(url):
-    return extract(url).domain + ".key"
-
-def _gen_db_sub_domain_key(url):
-    return _concat_sub(url, ".key")
-
-def _gen_db_full_domain_key(url):
-    return _concat_full(url, ".key")
-
-def _gen_db_domain_pem(url):
-    return extract(url).domain + ".pem"
-
-def _gen_db_sub_domain_pem(url):
-    return _concat_sub(url, ".pem")
-
-def _gen_db_full_domain_pem(url):
-    return _concat_full(url, ".pem")
-
-TRIALS = [
-    ('server-status/', 'Apache Server Status'),
-    ('server-info/', 'Apache Server Information'),
-    ('test.php', 'phpinfo()'),
-    ('phpinfo.php', 'phpinfo()'),
-    ('.git/HEAD', 'ref:'),
-    ('.svn/wc.db', 'SQLite'),
-    ('core', 'ELF'),
-    ### Check for Database dumps
-    # sqldump - mysql
-    ('dump.db', _match_db_dump),
-    ('dump.sql', _match_db_dump),
-    ('sqldump.sql', _match_db_dump),
-    ('sqldump.db', _match_db_dump),
-    # SQLite
-    ('db.sqlite', _match_db_dump),
-    ('data.sqlite', _match_db_dump),
-    ('sqlite.db', _match_db_dump),
-    (_gen_db_domain_sql, _match_db_dump),
-    (_gen_db_sub_domain_sql, _match_db_dump),
-    (_gen_db_full_domain_sql, _match_db_dump),
-    (_gen_db_domain_db, _match_db_dump),
-    (_gen_db_sub_domain_db, _match_db_dump),
-    (_gen_db_full_domain_db, _match_db_dump),
-
-    # TODO PostgreSQL etc., additional common names
-
-    # TLS Certs
-    ('server.key', '-----BEGIN'),
-    ('privatekey.key', '-----BEGIN'),
-    ('private.key', '-----BEGIN'),
-    ('myserver.key', '-----BEGIN'),
-    ('key.pem', '-----BEGIN'),
-    ('privkey.pem', '-----BEGIN'),
-    (_gen_db_domain_key, '-----BEGIN'),
-    (_gen_db_sub_domain_key, '-----BEGIN'),
-    (_gen_db_full_domain_key, '-----BEGIN'),
-    (_gen_db_domain_pem, '-----BEGIN'),
-    (_gen_db_sub_domain_pem, '-----BEGIN'),
-    (_gen_db_full_domain_pem, '-----BEGIN'),
-    # TODO Add [domainname].key, [domainname].pem
-]
-
-def _get(url, timeout):
+    def find_strings(self, text: str) -> set:
+        """Find the strings of all trials contained in text."""
+        found = set()
+        if self._strings is None:
+            return found
+        for string in {m.group(1) for m in self._strings.finditer(text)}:
+            found.update(self._contained[string])
+        return found
+
+
+_trials = {}
+
+
+def _load_trials(path: str) -> _Trials:
+    if path not in _trials:
+        _trials[path] = _Trials(path)
+    return _trials[path]
+
+
+def _get(session: requests.Session, url: str, timeout: int) -> Tuple[Response, bytes]:
+    """Get url and return the response and at most MAX_CONTENT_SIZE bytes
+    of its content."""
     try:
-        response = requests.get(url, timeout=timeout)
-        return response
+        with session.get(url, timeout=timeout, stream=True) as response:
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=8192):
+                content += chunk
+                if len(content) >= MAX_CONTENT_SIZE:
+                    # abort large downloads, the connection is closed
+                    break
+            return response, bytes(content[:MAX_CONTENT_SIZE])
     except ConnectionError:
         return None
 
-def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str, bytes]]]:
+def test_site(url: str, previous_results: dict, concurrency: int = 8,
+              trials_path: str = DEFAULT_TRIALS_PATH) -> Dict[str, Dict[str, Union[str, bytes]]]:
     raw_requests = {
         'url': {
             'mime_type': 'text/plain',
@@ -134,18 +148,21 @@ def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str
     # determine hostname
     parsed_url = urlparse(url)
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
+    # all trials use the connections to the same host
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    with session, ThreadPoolExecutor(max_workers=concurrency) as executor:
         url_to_future = {}
-        for trial, pattern in TRIALS:
-            trial_t = trial
-            # Check if trial is callable. If so, call it and save the result
-            if callable(trial):
-                trial_t = trial(url)
-                if trial_t is None:
-                    continue
+        for trial, _ in _load_trials(trials_path).plan(url):
+            if trial in url_to_future:
+                continue
             request_url = '{}://{}/{}'.format(
-                parsed_url.scheme, parsed_url.netloc, trial_t)
-            url_to_future[trial_t] = executor.submit(_get, request_url, 10)
+                parsed_url.scheme, parsed_url.netloc, trial)
+            url_to_future[trial] = executor.submit(
+                _get, session, request_url, 10)
 
         for trial in url_to_future:
             try:
@@ -153,6 +170,7 @@ def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str
                 response = url_to_future[trial].result()
                 if response is None:
                     continue
+                response, content = response
 
                 match_url = '{}/{}'.format(parsed_url.netloc, trial)
 
@@ -162,7 +180,7 @@ def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str
                 
                 raw_requests[trial] = {
                     'mime_type': 'application/json',
-                    'data': _response_to_json(response),
+                    'data': _response_to_json(response, content),
                 }
             except Exception:
                 continue
@@ -170,7 +188,8 @@ def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str
     return raw_requests
 
 
-def process_test_data(raw_data: list, previous_results: dict) -> Dict[str, Dict[str, object]]:
+def process_test_data(raw_data: list, previous_results: dict, concurrency: int = 8,
+                      trials_path: str = DEFAULT_TRIALS_PATH) -> Dict[str, Dict[str, object]]:
     leaks = []
     result = {}
     
@@ -178,43 +197,25 @@ def process_test_data(raw_data: list, previous_results: dict) -> Dict[str, Dict[
     if 'url' in raw_data:
         url = raw_data['url']['data'].decode()
 
-    for trial, pattern in TRIALS:
-        if url:
-            if callable(trial):
-                trial = trial(url)
-                if trial is None:
-                    continue
+    trials = _load_trials(trials_path)
+    for trial, index in trials.plan(url):
         if trial not in raw_data:
             # Test raw data too old or particular request failed.
             continue
         response = json.loads(raw_data[trial]['data'].decode())
         if response['status_code'] == 200:
-            # The pattern can have three different types.
-            # - If it is a simple string, we only check if it is contained in the response
-            if isinstance(pattern, str):
-                if pattern in response['text']:
-                    leaks.append(trial)
-            # - If it is a RegEx object, we perform a pattern match
-            elif isinstance(pattern, re._pattern_type):
-                if re.match(response['text']):
-                    leaks.append(trial)
-            # - If it is callable, we call it with the response text and check the return value
-            elif callable(pattern):
-                if pattern(response['text']):
-                    leaks.append(trial)
+            if trials.is_leak(index, response['text']):
+                leaks.append(trial)
 
     result['leaks'] = leaks
     return result
 
 
-def _response_to_json(resp: Response) -> bytes:
-    """Generate a json byte string from a response received through requests."""
-    # we store only the top of the file because core dumps can become very large
-    # also: we do not want to store more potentially sensitive data than necessary
-    # to determine whether there is a leak or not
-    
+def _response_to_json(resp: Response, content: bytes) -> bytes:
+    """Generate a json byte string from a response received through requests
+    and the (truncated) content of the response."""
     return json.dumps({
-        'text': resp.content[0:50*1024].decode(errors='replace'),
+        'text': content.decode(errors='replace'),
         'status_code': resp.status_code,
         'headers': dict(resp.headers),
         'url': resp.url,
@@ -1,14 +1,22 @@
 """
 Common functionality for testssl-based checks.
 """
+import json
 import os
 import re
 import tempfile
 from pprint import pprint
+from time import sleep, time
+from typing import Dict, Iterable, List
+from urllib.parse import urlparse
 
-from subprocess import call, check_output, DEVNULL
+from subprocess import DEVNULL
 
 from django.conf import settings
+from redis import RedisError, StrictRedis
+
+from privacyscore.utils import get_redis_connection, \
+    get_supervisor_deadline, supervised_call, supervised_check_output
 
 from pprint import pprint
 
@@ -16,37 +24,230 @@ from pprint import pprint
 TESTSSL_PATH = os.path.join(
     settings.SCAN_TEST_BASEPATH, 'vendor/testssl.sh', 'testssl.sh')
 
+TRUST_PATTERN = re.compile(r'(^trust$)|(.*? trust)')
+CHAIN_PATTERN = re.compile(r'.*?chain_of_trust$')
+OFFERED_PATTERN = re.compile(r'is (not )?offered')
+HIGHER_VERSION_PATTERN = re.compile(r'higher version number')
+
+
+class TestsslResult:
+    """
+    Indexed view of the first scan result of a testssl json result.
+
+    The items of each section (e.g. protocols or headerResponse) are indexed
+    by their id once, so looking up an item does not search the section.
+    """
+    def __init__(self, data: dict):
+        self.data = data
+        self.target_host = data.get('target host')
+        self._sections = {}
+        self._index = {}
+        for section, items in data['scanResult'][0].items():
+            if not isinstance(items, list):
+                continue
+            self._sections[section] = items
+            index = {}
+            for item in items:
+                # like get_list_item_by_dict_entry, the first item wins
+                index.setdefault(item.get('id'), item)
+            self._index[section] = index
+
+    def get(self, section: str, id: str) -> dict:
+        """Get the first item of section with the specified id."""
+        return self._index.get(section, {}).get(id)
+
+    def items(self, section: str) -> Iterable[dict]:
+        """Get all items of section in their original order."""
+        return self._sections.get(section, [])
+
+
+def load_testssl_json(raw: bytes) -> dict:
+    """
+    Decode a raw testssl json result.
+
+    Some results of old testssl versions contain escape sequences which are
+    invalid json; only these are decoded using unicode_escape.
+    """
+    try:
+        return json.loads(raw.decode())
+    except ValueError:
+        return json.loads(raw.decode('unicode_escape'))
+
+
+def get_https_hostname(url: str, previous_results: dict) -> str:
+    """
+    Determine the hostname of the https server of a site, or None if the
+    site is not available via https.
+    """
+    scan_url = previous_results.get('final_https_url')
+    if scan_url and (previous_results.get('same_content_via_https') or previous_results.get('final_url_is_https')):
+        return urlparse(scan_url).hostname
+    elif url.startswith('https'):
+        return urlparse(url).hostname
+    return None
+
+
+def run_testssl(hostname: str, check_mx: bool, remote_host: str = None,
+                cache_timeout: int = None) -> bytes:
+    """
+    Test the specified hostname with testssl and return the raw json result.
+
+    If a cache timeout (in seconds) is given, results are shared between all
+    scans of the same host within the timeout. Concurrent scans of the same
+    host wait for a single run of testssl, but for at most half of the time
+    left until the deadline of the active ProcessSupervisor. Afterwards,
+    testssl is run without waiting any longer. If the cache is not
+    available, testssl is run without it.
+    """
+    if not cache_timeout:
+        return _run_testssl(hostname, check_mx, remote_host)
+
+    key = _cache_key(hostname, check_mx)
+    lock_key = '{}:lock'.format(key)
+    redis = get_redis_connection(settings.SCAN_CACHE_URL)
+    deadline = get_supervisor_deadline()
+    wait_until = None
+    if deadline is not None:
+        wait_until = time() + (deadline - time()) / 2
+    locked = False
+    try:
+        while True:
+            out = redis.get(key)
+            if out is not None:
+                return out
+            # the lock expires in case its holder has been killed
+            if redis.set(lock_key, b'', nx=True,
+                         ex=settings.SCAN_SUITE_TIMEOUT_SECONDS):
+                locked = True
+                break
+            if wait_until is not None and time() >= wait_until:
+                break
+            sleep(5)
+    except RedisError:
+        # the cache is only an optimization
+        return _run_testssl(hostname, check_mx, remote_host)
+
+    try:
+        out = _run_testssl(hostname, check_mx, remote_host)
+        if out:
+            _set_cached(redis, key, out, cache_timeout)
+        return out
+    finally:
+        if locked:
+            _delete_cached(redis, lock_key)
+
+
+def get_cached_testssl(hostname: str, check_mx: bool, tag: str) -> bytes:
+    """
+    Get the result of testssl for hostname cached under the specified tag,
+    e.g. a fingerprint of the tls configuration, or None.
+    """
+    try:
+        redis = get_redis_connection(settings.SCAN_CACHE_URL)
+        return redis.get('{}:{}'.format(_cache_key(hostname, check_mx), tag))
+    except RedisError:
+        return None
+
+
+def cache_testssl(hostname: str, check_mx: bool, tag: str, out: bytes,
+                  cache_timeout: int):
+    """Cache a result of testssl for hostname under the specified tag."""
+    if not out:
+        return
+    redis = get_redis_connection(settings.SCAN_CACHE_URL)
+    _set_cached(redis, '{}:{}'.format(_cache_key(hostname, check_mx), tag),
+                out, cache_timeout)
+
+
+def run_testssl_batch(hostnames: List[str], check_mx: bool,
+                      cache_timeout: int):
+    """
+    Test the specified hostnames with a single invocation of testssl and
+    store the results in the cache used by run_testssl.
+
+    The hosts are tested in parallel. Hosts with a cached result or a
+    running test are skipped. Nothing is tested if the cache is not
+    available.
+    """
+    redis = get_redis_connection(settings.SCAN_CACHE_URL)
+    locked = []
+    try:
+        try:
+            for hostname in sorted(set(hostnames)):
+                key = _cache_key(hostname, check_mx)
+                if redis.exists(key):
+                    continue
+                if redis.set('{}:lock'.format(key), b'', nx=True,
+                             ex=settings.SCAN_SUITE_TIMEOUT_SECONDS):
+                    locked.append(hostname)
+        except RedisError:
+            # the results could not be stored
+            return
+        if not locked:
+            return
+
+        for hostname, out in _local_testssl_batch(locked, check_mx).items():
+            out = _fix_json(out)
+            if out:
+                _set_cached(redis, _cache_key(hostname, check_mx), out,
+                            cache_timeout)
+    finally:
+        for hostname in locked:
+            _delete_cached(
+                redis, '{}:lock'.format(_cache_key(hostname, check_mx)))
+
+
+def _set_cached(redis: StrictRedis, key: str, out: bytes, cache_timeout: int):
+    try:
+        redis.set(key, out, ex=cache_timeout)
+    except RedisError:
+        # the cache is only an optimization
+        pass
+
+
+def _delete_cached(redis: StrictRedis, key: str):
+    try:
+        redis.delete(key)
+    except RedisError:
+        # the lock expires anyway
+        pass
+
+
+def _cache_key(hostname: str, check_mx: bool) -> str:
+    return 'privacyscore:testssl:{}:{}:{}'.format(
+        'smtp' if check_mx else 'https', hostname.lower(),
+        25 if check_mx else 443)
 
-def run_testssl(hostname: str, check_mx: bool, remote_host: str = None) -> bytes:
-    """Test the specified hostname with testssl and return the raw json result."""
+
+def _run_testssl(hostname: str, check_mx: bool, remote_host: str = None) -> bytes:
     # determine hostname
     if remote_host:
         out =  _remote_testssl(hostname, remote_host)
     else:
         out = _local_testssl(hostname, check_mx)
 
-    # fix json syntax error
-    out = re.sub(r'"Invocation.*?\n', '', out.decode(), 1).encode()
+    return _fix_json(out)
+
 
-    return out
+def _fix_json(out: bytes) -> bytes:
+    """Fix the json syntax error caused by the invocation line."""
+    return re.sub(r'"Invocation.*?\n', '', out.decode(), 1).encode()
 
 
-def parse_common_testssl(json: str, prefix: str):
+def parse_common_testssl(result: TestsslResult, prefix: str):
     """Perform common parsing tasks on result JSONs."""
-    result = {
+    parsed = {
         '{}_has_ssl'.format(prefix): True,  # otherwise an exception would have been thrown before
     }
 
     # Detect if cert is valid
     trust_cert = None
     trust_chain = None
-    trust_pat = re.compile(r'(^trust$)|(.*? trust)')
-    chain_pat = re.compile(r'.*?chain_of_trust$')
     # TODO If a server uses more than one certificate, this code will validate only the last one.
-    for default in json['scanResult'][0]['serverDefaults']:
-        if trust_pat.search(default['id']) is not None:
+    for default in result.items('serverDefaults'):
+        if TRUST_PATTERN.search(default['id']) is not None:
             trust_cert = default
-        elif chain_pat.search(default['id']) is not None:
+        elif CHAIN_PATTERN.search(default['id']) is not None:
             trust_chain = default
         elif default["id"] == "issuer" and default["severity"] == "CRITICAL":
             trust_chain = default
@@ -63,34 +264,32 @@ def parse_common_testssl(json: str, prefix: str):
         reason += trust_chain['finding']
         trusted = False
 
-    result['{}_cert_trusted'.format(prefix)] = trusted
-    result['{}_cert_trusted_reason'.format(prefix)] = reason
+    parsed['{}_cert_trusted'.format(prefix)] = trusted
+    parsed['{}_cert_trusted_reason'.format(prefix)] = reason
 
 
     # pfs
-    result['{}_pfs'.format(prefix)] = json['scanResult'][0]['pfs'][0]['severity'] == 'OK'
+    parsed['{}_pfs'.format(prefix)] = result.items('pfs')[0]['severity'] == 'OK'
 
     # detect protocols
-    pattern = re.compile(r'is (not )?offered')
-    for p in json['scanResult'][0]['protocols']:
+    for p in result.items('protocols'):
         if p['severity'] == "CRITICAL":
             # Hardcoded special case to grab a specific error
             # This is horrible style
             # TODO make less horrible
-            pat = re.compile(r'higher version number')
-            match = pat.search(p['finding'])
-            result['{}_has_protocol_{}'.format(prefix, p['id'])] = match is None
+            match = HIGHER_VERSION_PATTERN.search(p['finding'])
+            parsed['{}_has_protocol_{}'.format(prefix, p['id'])] = match is None
             continue
-        match = pattern.search(p['finding'])
+        match = OFFERED_PATTERN.search(p['finding'])
         if not match:
             continue
-        result['{}_has_protocol_{}'.format(prefix, p['id'])] = match.group(1) is None
+        parsed['{}_has_protocol_{}'.format(prefix, p['id'])] = match.group(1) is None
 
     # Detect vulnerabilities
-    result['{}_vulnerabilities'.format(prefix)] = {}
-    for vuln in json['scanResult'][0]['vulnerabilities']:
+    parsed['{}_vulnerabilities'.format(prefix)] = {}
+    for vuln in result.items('vulnerabilities'):
         if vuln['severity'] != u"OK" and vuln['severity'] != u'INFO':
-            result['{}_vulnerabilities'.format(prefix)][vuln['id']] = {
+            parsed['{}_vulnerabilities'.format(prefix)][vuln['id']] = {
                 'severity': vuln['severity'],
                 'cve': vuln['cve'] if 'cve' in vuln.keys() else "",
                 'finding': vuln['finding'],
@@ -98,19 +297,19 @@ def parse_common_testssl(json: str, prefix: str):
     
     # Detect ciphers
     # TODO Do we maybe want to get all cipher info, not only the bad ones?
-    result['{}_ciphers'.format(prefix)] = {}
-    for cipher in json['scanResult'][0]['ciphers']:
+    parsed['{}_ciphers'.format(prefix)] = {}
+    for cipher in result.items('ciphers'):
         if cipher['severity'] != u"OK" and cipher['severity'] != u'INFO':
-            result['{}_ciphers'.format(prefix)][cipher['id']] = {
+            parsed['{}_ciphers'.format(prefix)][cipher['id']] = {
                 'severity': cipher['severity'],
                 'finding': cipher['finding'],
             }
 
-    return result
+    return parsed
 
 def _remote_testssl(hostname: str, remote_host: str) -> bytes:
     """Run testssl over ssh."""
-    return check_output([
+    return supervised_check_output([
         'ssh',
         remote_host,
         hostname,
@@ -120,6 +319,58 @@ def _remote_testssl(hostname: str, remote_host: str) -> bytes:
 def _local_testssl(hostname: str, check_mx: bool) -> bytes:
     result_file = tempfile.mktemp()
 
+    supervised_call(_testssl_args(hostname, check_mx, result_file),
+                    stdout=DEVNULL, stderr=DEVNULL)
+
+    # exception when file does not exist.
+    with open(result_file, 'rb') as file:
+        result = file.read()
+    # delete json file.
+    os.remove(result_file)
+
+    # store raw scan result
+    return result
+
+
+def _local_testssl_batch(hostnames: List[str], check_mx: bool) -> Dict[str, bytes]:
+    """
+    Test all hostnames in parallel using the mass testing mode of testssl.
+
+    Each line of the mass testing file holds the arguments of one test which
+    writes its result to a separate file. Hosts whose test did not produce a
+    result are missing in the returned dict.
+    """
+    with tempfile.TemporaryDirectory() as result_dir:
+        result_files = {
+            hostname: os.path.join(result_dir, '{}.json'.format(i))
+            for i, hostname in enumerate(hostnames)}
+        mass_file = os.path.join(result_dir, 'hosts')
+        with open(mass_file, 'w') as file:
+            for hostname, result_file in result_files.items():
+                # the arguments of each line are used for a separate
+                # invocation of testssl, so they must not be repeated for
+                # the invocation running the mass test
+                file.write(' '.join(
+                    _testssl_args(hostname, check_mx, result_file)[1:]))
+                file.write('\n')
+
+        env = dict(os.environ, MAX_PARALLEL=str(len(hostnames)))
+        supervised_call([
+            TESTSSL_PATH,
+            '--file', mass_file,
+            '--parallel',
+        ], stdout=DEVNULL, stderr=DEVNULL, env=env)
+
+        results = {}
+        for hostname, result_file in result_files.items():
+            if not os.path.isfile(result_file):
+                continue
+            with open(result_file, 'rb') as file:
+                results[hostname] = file.read()
+        return results
+
+
+def _testssl_args(hostname: str, check_mx: bool, result_file: str) -> List[str]:
     args = [
         TESTSSL_PATH,
         '-p', # enable all checks for presence of SSLx.x and TLSx.x protocols
@@ -146,14 +397,4 @@ def _local_testssl(hostname: str, check_mx: bool) -> bytes:
         ])
     else:
         args.append(hostname)
-
-    call(args, stdout=DEVNULL, stderr=DEVNULL)
-
-    # exception when file does not exist.
-    with open(result_file, 'rb') as file:
-        result = file.read()
-    # delete json file.
-    os.remove(result_file)
-
-    # store raw scan result
-    return result
+    return args
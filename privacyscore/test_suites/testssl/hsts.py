@@ -0,0 +1,87 @@
+"""
+Index of the Chromium HSTS preload list.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+from django.conf import settings
+
+
+HSTS_PRELOAD_PATH = os.path.join(
+    settings.SCAN_TEST_BASEPATH, 'vendor/HSTSPreload',
+    'transport_security_state_static')
+HSTS_PRELOAD_INDEX_PATH = HSTS_PRELOAD_PATH + '.index'
+
+# The index of the process and the modification time of the list it has
+# been built from.
+_index = None
+
+
+def is_preloaded(host: str) -> bool:
+    """
+    Check whether host is on the HSTS preload list, either by itself or
+    by a parent domain whose policy includes subdomains.
+    """
+    index = get_preload_index()
+    # Check if exact hostname is included
+    if host in index:
+        return True
+    # If not included, construct ever shorter hostnames and look for policies
+    # on those versions that include subdomains
+    split = host.split('.')
+    return any(index.get('.'.join(split[i:]))
+               for i in range(1, len(split)))
+
+
+def get_preload_index() -> dict:
+    """
+    Get the index of the preload list, mapping each name to whether its
+    policy includes subdomains.
+
+    The index is built once per process and rebuilt when the list changes.
+    It is also stored in HSTS_PRELOAD_INDEX_PATH to be reused by other
+    processes as long as the list does not change.
+    """
+    global _index
+    mtime = os.stat(HSTS_PRELOAD_PATH).st_mtime
+    if _index is None or _index[0] != mtime:
+        _index = mtime, _load_preload_index()
+    return _index[1]
+
+
+def _load_preload_index() -> dict:
+    with open(HSTS_PRELOAD_PATH, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).digest()
+
+    try:
+        with open(HSTS_PRELOAD_INDEX_PATH, 'rb') as f:
+            cached_digest, index = pickle.load(f)
+        if cached_digest == digest:
+            return index
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        # no (usable) prebuilt index
+        pass
+
+    index = {}
+    for entry in json.loads(content.decode())['entries']:
+        index[entry['name']] = (index.get(entry['name'], False) or
+                                bool(entry.get('include_subdomains')))
+
+    temp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(HSTS_PRELOAD_INDEX_PATH),
+                delete=False) as f:
+            temp_path = f.name
+            pickle.dump((digest, index), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, HSTS_PRELOAD_INDEX_PATH)
+    except OSError:
+        # the prebuilt index is optional
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return index
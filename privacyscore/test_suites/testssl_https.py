@@ -4,40 +4,51 @@ Test the SSL configuration of the web server.
 
 import json
 import re
-import os
 from typing import Dict, Union
-from urllib.parse import urlparse
 
 from django.conf import settings
-from privacyscore.utils import get_list_item_by_dict_entry
 
-from .testssl.common import run_testssl, parse_common_testssl
+from .testssl.common import TestsslResult, cache_testssl, \
+    get_cached_testssl, get_https_hostname, load_testssl_json, run_testssl, \
+    parse_common_testssl
+from .testssl.hsts import is_preloaded
 
 test_name = 'testssl_https'
 test_dependencies = [
     'network',
 ]
-
-
-def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str, bytes]]]:
-    # Commented out for now because it gives bad results sometimes
-    scan_url = previous_results.get('final_https_url')
-    if scan_url and (previous_results.get('same_content_via_https') or previous_results.get('final_url_is_https')):
-        hostname = urlparse(scan_url).hostname
-    elif url.startswith('https'):
-        hostname = urlparse(url).hostname
-    else:
+# The fingerprint of tlsprobe is only needed to reuse the last result. As the
+# probe delays testssl by a round of handshakes, it runs in parallel otherwise.
+if dict(settings.SCAN_TEST_SUITES).get(test_name, {}).get(
+        'unchanged_cache_timeout'):
+    test_dependencies.append('tlsprobe')
+test_resources = {
+    'cpu': 1,
+}
+
+
+def test_site(url: str, previous_results: dict, cache_timeout: int = None,
+              unchanged_cache_timeout: int = None) -> Dict[str, Dict[str, Union[str, bytes]]]:
+    hostname = get_https_hostname(url, previous_results)
+    if hostname is None:
         return {
             'jsonresult': {
                 'mime_type': 'application/json',
                 'data': b'',
             },
         }
-    #
-    #hostname = urlparse(scan_url).hostname
 
-    # hostname = urlparse(url).hostname
-    jsonresult = run_testssl(hostname, False)
+    # As long as the tls probe sees no change, the last result of testssl
+    # is reused.
+    fingerprint = previous_results.get('tlsprobe_fingerprint')
+    if fingerprint and unchanged_cache_timeout:
+        jsonresult = get_cached_testssl(hostname, False, fingerprint)
+        if jsonresult is None:
+            jsonresult = run_testssl(hostname, False, cache_timeout=cache_timeout)
+            cache_testssl(hostname, False, fingerprint, jsonresult,
+                          unchanged_cache_timeout)
+    else:
+        jsonresult = run_testssl(hostname, False, cache_timeout=cache_timeout)
 
     return {
         'jsonresult': {
@@ -47,15 +58,15 @@ def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str
     }
 
 
-def process_test_data(raw_data: list, previous_results: dict) -> Dict[str, Dict[str, object]]:
+def process_test_data(raw_data: list, previous_results: dict, cache_timeout: int = None,
+                      unchanged_cache_timeout: int = None) -> Dict[str, Dict[str, object]]:
     """Process the raw data of the test."""
     rv = {'web_ssl_finished': True}
     if raw_data['jsonresult']['data'] == b'':
         rv['web_has_ssl'] = False
         return rv
 
-    data = json.loads(
-        raw_data['jsonresult']['data'].decode('unicode_escape'))
+    data = load_testssl_json(raw_data['jsonresult']['data'])
 
     if not 'scanResult' in data:
         # something went wrong with this test.
@@ -68,41 +79,23 @@ def process_test_data(raw_data: list, previous_results: dict) -> Dict[str, Dict[
         return rv
 
     # Grab common information
-    result = parse_common_testssl(data, "web")
+    testssl_result = TestsslResult(data)
+    result = parse_common_testssl(testssl_result, "web")
     result["web_ssl_finished"] = True
 
     # detect headers
-    result.update(_detect_hsts(data))
-    result.update(_detect_hpkp(data))
+    result.update(_detect_hsts(testssl_result))
+    result.update(_detect_hpkp(testssl_result))
 
     return result
 
 
-def _detect_hsts(data: dict) -> dict:
-    def _check_contained(preloads, domain, subdomains=False):
-        for entry in preloads["entries"]:
-            if entry["name"] == domain:
-                if subdomains:
-                    try:
-                        if entry["include_subdomains"]:
-                            return True
-                    except:
-                        pass
-                else:
-                    return True
-        return False
-
+def _detect_hsts(data: TestsslResult) -> dict:
     result = {}
 
-    hsts_item = get_list_item_by_dict_entry(
-        data['scanResult'][0]['headerResponse'],
-        'id', 'hsts')
-    hsts_time_item = get_list_item_by_dict_entry(
-        data['scanResult'][0]['headerResponse'],
-        'id', 'hsts_time')
-    hsts_preload_item = get_list_item_by_dict_entry(
-        data['scanResult'][0]['headerResponse'],
-        'id', 'hsts_preload')
+    hsts_item = data.get('headerResponse', 'hsts')
+    hsts_time_item = data.get('headerResponse', 'hsts_time')
+    hsts_preload_item = data.get('headerResponse', 'hsts_preload')
 
     # Look for HSTS Preload header
     result['web_has_hsts_preload_header'] = False
@@ -121,41 +114,20 @@ def _detect_hsts(data: dict) -> dict:
         result["web_has_hsts_header_sufficient_time"] = hsts_time_item['severity'] == 'OK'
 
     # Check the HSTS Preloading database
-    result["web_has_hsts_preload"] = False
-    with open(os.path.join(settings.SCAN_TEST_BASEPATH, "vendor/HSTSPreload", "transport_security_state_static")) as fo:
-        preloads = json.loads(fo.read())
-    host = data["target host"]
-    # Check if exact hostname is included
-    if not _check_contained(preloads, host):
-        # If not included, construct ever shorter hostnames and look for policies
-        # on those versions that include subdomains
-        split = host.split(".")
-        for i in range(1, len(split)):
-            if _check_contained(preloads, ".".join(split[i:]), True):
-                # Found
-                result["web_has_hsts_preload"] = True
-    else:
-        # Found
-        result["web_has_hsts_preload"] = True
+    result["web_has_hsts_preload"] = is_preloaded(data.target_host)
     return result
 
 
-def _detect_hpkp(data: dict) -> dict:
-    hpkp_item = get_list_item_by_dict_entry(
-        data['scanResult'][0]['headerResponse'],
-        'id', 'hpkp')
-    hpkp_spkis = get_list_item_by_dict_entry(
-        data['scanResult'][0]['headerResponse'],
-        'id', 'hpkp_spkis')
+def _detect_hpkp(data: TestsslResult) -> dict:
+    hpkp_item = data.get('headerResponse', 'hpkp')
+    hpkp_spkis = data.get('headerResponse', 'hpkp_spkis')
 
     if hpkp_item is not None:
         return {'web_has_hpkp_header': not hpkp_item['finding'].startswith('No')}
     elif hpkp_spkis is not None:
         return {'web_has_hpkp_header': hpkp_spkis['severity'] == "OK"}
 
-    hpkp_item = get_list_item_by_dict_entry(
-        data['scanResult'][0]['headerResponse'],
-        'id', 'hpkp_multiple')
+    hpkp_item = data.get('headerResponse', 'hpkp_multiple')
     if hpkp_item is not None:
         return {'web_has_hpkp_header': True}
 
@@ -7,13 +7,18 @@ import re
 from typing import Dict, Union
 from urllib.parse import urlparse
 
-from .testssl.common import run_testssl, parse_common_testssl
+from .testssl.common import TestsslResult, load_testssl_json, run_testssl, \
+    parse_common_testssl
 
 test_name = 'testssl_mx'
 test_dependencies = ['network']
+test_resources = {
+    'cpu': 1,
+}
 
 
-def test_site(url: str, previous_results: dict, remote_host: str = None) -> Dict[str, Dict[str, Union[str, bytes]]]:
+def test_site(url: str, previous_results: dict, remote_host: str = None,
+              cache_timeout: int = None) -> Dict[str, Dict[str, Union[str, bytes]]]:
     # test first mx
     try:
         hostname = previous_results['mx_records'][0][1]
@@ -25,7 +30,8 @@ def test_site(url: str, previous_results: dict, remote_host: str = None) -> Dict
             },
         }
 
-    jsonresult = run_testssl(hostname, True, remote_host)
+    # mail servers are commonly shared by many sites
+    jsonresult = run_testssl(hostname, True, remote_host, cache_timeout)
 
     return {
         'jsonresult': {
@@ -35,15 +41,15 @@ def test_site(url: str, previous_results: dict, remote_host: str = None) -> Dict
     }
 
 
-def process_test_data(raw_data: list, previous_results: dict, remote_host: str = None) -> Dict[str, Dict[str, object]]:
+def process_test_data(raw_data: list, previous_results: dict, remote_host: str = None,
+                      cache_timeout: int = None) -> Dict[str, Dict[str, object]]:
     """Process the raw data of the test."""
     result = {"mx_ssl_finished": True}
     if raw_data['jsonresult']['data'] == b'':
         result['mx_has_ssl'] = False
         return result
 
-    data = json.loads(
-        raw_data['jsonresult']['data'].decode())
+    data = load_testssl_json(raw_data['jsonresult']['data'])
     # Attempt at solving
     # try:
     #     data = json.loads(
@@ -60,5 +66,5 @@ def process_test_data(raw_data: list, previous_results: dict, remote_host: str =
 
     # TODO: Parse mx result -- there are no http headers to analyze here ...
 
-    result.update(parse_common_testssl(data, "mx"))
+    result.update(parse_common_testssl(TestsslResult(data), "mx"))
     return result
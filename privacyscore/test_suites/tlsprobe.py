@@ -0,0 +1,245 @@
+"""
+Probe the TLS configuration of the web server using a few handshakes.
+
+This is a fast subset of testssl_https: The supported protocols, the trust
+of the certificate and forward secrecy are determined by concurrent
+handshakes using the ssl module. The results are kept separate from those of
+testssl_https, which only uses the fingerprint of the probed configuration
+and the security headers to reuse its last result as long as nothing
+changed.
+"""
+import hashlib
+import json
+import socket
+import ssl
+from http.client import HTTPException, HTTPSConnection
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Union
+
+from .testssl.common import get_https_hostname
+
+test_name = 'tlsprobe'
+test_dependencies = [
+    'network',
+]
+
+
+# The protocols as named in the result keys, together with the name of their
+# ssl.TLSVersion member and the protocol constant of older python versions.
+# Protocols the local OpenSSL does not support are not probed.
+PROTOCOLS = [
+    ('sslv2', 'SSLv2', 'PROTOCOL_SSLv2'),
+    ('sslv3', 'SSLv3', 'PROTOCOL_SSLv3'),
+    ('tls1', 'TLSv1', 'PROTOCOL_TLSv1'),
+    ('tls1_1', 'TLSv1_1', 'PROTOCOL_TLSv1_1'),
+    ('tls1_2', 'TLSv1_2', 'PROTOCOL_TLSv1_2'),
+    ('tls1_3', 'TLSv1_3', None),
+]
+
+# Cipher suites with forward secrecy for protocols up to TLS 1.2; all cipher
+# suites of TLS 1.3 provide forward secrecy.
+PFS_CIPHERS = 'EECDH:EDH:!aNULL:!eNULL'
+
+# The response headers which are part of the fingerprint, so that the result
+# of testssl_https is not reused after its header checks changed. The server
+# header serves as an indicator for software updates, which may fix or
+# introduce vulnerabilities. Headers which commonly differ between responses
+# (e.g. content-security-policy with nonces) are left out.
+FINGERPRINT_HEADERS = [
+    'public-key-pins',
+    'public-key-pins-report-only',
+    'referrer-policy',
+    'server',
+    'strict-transport-security',
+    'x-content-type-options',
+    'x-frame-options',
+    'x-xss-protection',
+]
+
+
+def test_site(url: str, previous_results: dict, timeout: int = 10) -> Dict[str, Dict[str, Union[str, bytes]]]:
+    hostname = get_https_hostname(url, previous_results)
+    if hostname is None:
+        return {
+            'jsonresult': {
+                'mime_type': 'application/json',
+                'data': b'',
+            },
+        }
+
+    contexts = {
+        protocol: _protocol_context(version, constant)
+        for protocol, version, constant in PROTOCOLS}
+    contexts = {
+        protocol: context for protocol, context in contexts.items()
+        if context is not None}
+
+    with ThreadPoolExecutor(max_workers=len(contexts) + 4) as executor:
+        default_future = executor.submit(
+            _handshake, hostname, _unverified_context(), timeout)
+        trust_future = executor.submit(
+            _verify, hostname, ssl.create_default_context(), timeout)
+        pfs_future = executor.submit(
+            _handshake, hostname, _pfs_context(), timeout)
+        headers_future = executor.submit(_get_headers, hostname, timeout)
+        protocol_futures = {
+            protocol: executor.submit(_handshake, hostname, context, timeout)
+            for protocol, context in contexts.items()}
+
+        probe = {
+            'hostname': hostname,
+            'protocols': {},
+        }
+        default = default_future.result()
+        probe['has_ssl'] = bool(default)
+        if default:
+            probe['cipher'] = default['cipher']
+            probe['cert_sha256'] = default['cert_sha256']
+        probe['cert_trusted'], probe['cert_trusted_reason'] = \
+            trust_future.result()
+        for protocol, future in protocol_futures.items():
+            supported = future.result()
+            if supported is not None:
+                probe['protocols'][protocol] = bool(supported)
+        pfs = pfs_future.result()
+        probe['pfs'] = bool(pfs) or probe['protocols'].get('tls1_3', False)
+        probe['headers'] = headers_future.result()
+
+    return {
+        'jsonresult': {
+            'mime_type': 'application/json',
+            'data': json.dumps(probe).encode(),
+        },
+    }
+
+
+def process_test_data(raw_data: list, previous_results: dict, timeout: int = 10) -> Dict[str, Dict[str, object]]:
+    """Process the raw data of the test."""
+    result = {'tlsprobe_finished': True}
+    if raw_data['jsonresult']['data'] == b'':
+        result['tlsprobe_has_ssl'] = False
+        return result
+
+    probe = json.loads(raw_data['jsonresult']['data'].decode())
+    result['tlsprobe_has_ssl'] = probe['has_ssl']
+    if not probe['has_ssl']:
+        return result
+
+    result['tlsprobe_cert_trusted'] = probe['cert_trusted']
+    result['tlsprobe_cert_trusted_reason'] = probe['cert_trusted_reason']
+    result['tlsprobe_pfs'] = probe['pfs']
+    for protocol, supported in probe['protocols'].items():
+        result['tlsprobe_has_protocol_{}'.format(protocol)] = supported
+
+    # The cipher chosen by the server is left out because it may vary
+    # between the servers behind a load balancer.
+    result['tlsprobe_fingerprint'] = hashlib.sha256(json.dumps([
+        probe['hostname'],
+        probe['cert_sha256'],
+        probe['cert_trusted'],
+        probe['pfs'],
+        probe['protocols'],
+        probe.get('headers'),
+    ], sort_keys=True).encode()).hexdigest()
+
+    return result
+
+
+def _handshake(hostname: str, context: ssl.SSLContext, timeout: int) -> dict:
+    """
+    Perform a handshake with the https server of hostname.
+
+    Return the negotiated cipher and the hash of the certificate, False if
+    the handshake failed or None if the server could not be reached.
+    """
+    try:
+        with socket.create_connection((hostname, 443), timeout=timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=hostname) as tls:
+                return {
+                    'cipher': tls.cipher()[0],
+                    'cert_sha256': hashlib.sha256(
+                        tls.getpeercert(binary_form=True) or b'').hexdigest(),
+                }
+    except (ssl.SSLError, ConnectionResetError):
+        # servers commonly reset the connection on unsupported protocols
+        return False
+    except OSError:
+        return None
+
+
+def _get_headers(hostname: str, timeout: int) -> dict:
+    """Get the values of FINGERPRINT_HEADERS sent by the https server, or
+    None if the request failed."""
+    connection = HTTPSConnection(
+        hostname, timeout=timeout, context=_unverified_context())
+    try:
+        connection.request('GET', '/')
+        response = connection.getresponse()
+        headers = {}
+        for name, value in response.getheaders():
+            name = name.lower()
+            if name in FINGERPRINT_HEADERS:
+                headers[name] = ', '.join(filter(None, [headers.get(name), value]))
+        return headers
+    except (HTTPException, OSError):
+        return None
+    finally:
+        connection.close()
+
+
+def _verify(hostname: str, context: ssl.SSLContext, timeout: int) -> tuple:
+    """Check whether the certificate of the https server is trusted and
+    return the reason if not."""
+    try:
+        with socket.create_connection((hostname, 443), timeout=timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=hostname):
+                return True, ''
+    except (ssl.SSLError, ssl.CertificateError) as e:
+        return False, str(e)
+    except OSError as e:
+        return False, 'Connection failed: {}'.format(e)
+
+
+def _unverified_context(protocol: int = None) -> ssl.SSLContext:
+    if protocol is None:
+        protocol = getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23)
+    context = ssl.SSLContext(protocol)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    # offer weak cipher suites as well, they are part of what is probed
+    try:
+        context.set_ciphers('ALL:COMPLEMENTOFALL:@SECLEVEL=0')
+    except ssl.SSLError:
+        # the security level is unknown to old versions of OpenSSL
+        context.set_ciphers('ALL:COMPLEMENTOFALL')
+    return context
+
+
+def _protocol_context(version: str, constant: str) -> ssl.SSLContext:
+    """Create a context offering only the specified protocol, or None if it
+    is not supported locally."""
+    if hasattr(ssl, 'TLSVersion'):
+        if not getattr(ssl, 'HAS_{}'.format(version), False):
+            return None
+        context = _unverified_context()
+        try:
+            context.minimum_version = getattr(ssl.TLSVersion, version)
+            context.maximum_version = getattr(ssl.TLSVersion, version)
+        except ValueError:
+            return None
+        return context
+    if constant is None or not hasattr(ssl, constant):
+        return None
+    try:
+        return _unverified_context(getattr(ssl, constant))
+    except ValueError:
+        return None
+
+
+def _pfs_context() -> ssl.SSLContext:
+    context = _unverified_context()
+    if hasattr(ssl, 'TLSVersion'):
+        # the cipher suites of TLS 1.3 can not be restricted this way
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(PFS_CIPHERS)
+    return context
@@ -3,11 +3,21 @@ Utility functions that are shared across different modules.
 """
 
 import os
+import re
+import signal
+import subprocess
+import threading
 
-from pwd import getpwuid
-from typing import List, Tuple
+from functools import lru_cache
+from signal import SIGALRM, SIGKILL
+from string import ascii_letters, digits
+from time import time
+from typing import List
 
 from urllib.parse import urlparse
+from redis import StrictRedis
+from tldextract import TLDExtract
+from tldextract.tldextract import ExtractResult
 from url_normalize import url_normalize
 
 
@@ -34,17 +44,208 @@ def get_raw_data_by_identifier(raw_data: list, identifier: str):
         r[1] for r in raw_data if r[0]['identifier'] == identifier), None)
 
 
+# The public suffix list snapshot bundled with tldextract is used, it is
+# never fetched from the network.
+_tld_extract = TLDExtract(suffix_list_urls=())
+
+# extracts the hostname from an url the same way as tldextract
+_scheme = re.compile(r'^([' + ascii_letters + digits + '+-.' + ']+:)?//')
+
+
+def extract_domain(url: str) -> ExtractResult:
+    """
+    Split the hostname of an url into subdomain, domain and suffix.
+
+    Results are cached per hostname.
+    """
+    hostname = _scheme.sub('', url).partition('/')[0].partition('?')[0] \
+        .partition('#')[0].split('@')[-1].partition(':')[0].strip() \
+        .rstrip('.')
+    return _extract_hostname(hostname)
+
+
+@lru_cache(maxsize=10000)
+def _extract_hostname(hostname: str) -> ExtractResult:
+    return _tld_extract(hostname)
+
+
+_redis_connections = {}
+
+
+def get_redis_connection(url: str) -> StrictRedis:
+    """Get the connection to the redis server at url shared by the process."""
+    if url not in _redis_connections:
+        _redis_connections[url] = StrictRedis.from_url(url)
+    return _redis_connections[url]
+
+
 def get_list_item_by_dict_entry(search: list, key: str, value: str):
     """Get the first raw data element with the specified value for key."""
     return next((
         s for s in search if s[key] == value), None)
 
 
-def get_processes_of_user(user: str) -> List[Tuple[int, str]]:
-    """Get a tuple (pid, cmdline) for all processes of user."""
-    return [
-        (int(pid),
-         open('/proc/{}/cmdline'.format(pid), 'r').read())
-        for pid in os.listdir('/proc')
-        if (pid.isdigit() and
-            getpwuid(os.stat('/proc/{}'.format(pid)).st_uid).pw_name == user)]
+class ProcessSupervisor:
+    """
+    Supervise the subprocesses of a test suite.
+
+    Every subprocess started using supervised_popen while a supervisor is
+    active in the same thread runs in its own process group. When the
+    deadline expires, these process groups -- and only those -- are killed,
+    which allows multiple tests to run concurrently on the same host.
+    Process groups which are still alive when the supervisor is left are
+    killed as well.
+
+    If the supervisor is entered in the main thread, a TimeoutError is also
+    raised within the test suite when the deadline expires, so hangs within
+    python code are covered as well. In other threads, e.g. with a threaded
+    celery pool, these are only covered by the soft time limit of the task.
+    """
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        self.deadline = None
+        self.expired = False
+        self._process_groups = set()
+        # reentrant, as the alarm may interrupt the main thread holding it
+        self._lock = threading.RLock()
+        self._timer = None
+        self._outer = None
+        self._previous_handler = None
+
+    def __enter__(self):
+        self._outer = _get_current_supervisor()
+        _state.supervisor = self
+        self.deadline = time() + self.seconds
+        self._timer = threading.Timer(self.seconds, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+        if self._uses_alarm():
+            self._previous_handler = signal.signal(SIGALRM, self._alarm)
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._uses_alarm():
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(SIGALRM, self._previous_handler)
+        _state.supervisor = self._outer
+        self._timer.cancel()
+        self._kill_all()
+        if self.expired:
+            raise TimeoutError(
+                'Test suite did not finish within {} seconds'.format(
+                    self.seconds))
+
+    def register(self, pgid: int):
+        """Register a process group to supervise."""
+        with self._lock:
+            if self.expired:
+                _kill_process_group(pgid)
+                return
+            self._process_groups.add(pgid)
+
+    def unregister(self, pgid: int, kill: bool = True):
+        """
+        Stop supervising a process group and kill its remaining processes.
+
+        Killing has to happen before the leader of the group is reaped, as
+        its id may be reused afterwards.
+        """
+        with self._lock:
+            if pgid in self._process_groups:
+                if kill:
+                    _kill_process_group(pgid)
+                self._process_groups.discard(pgid)
+
+    def _uses_alarm(self) -> bool:
+        # signals are only delivered to the main thread, and a nested
+        # supervisor must not replace the alarm of the outer one
+        return self._outer is None and \
+            threading.current_thread() is threading.main_thread()
+
+    def _alarm(self, signum, frame):
+        self._expire()
+        raise TimeoutError(
+            'Test suite did not finish within {} seconds'.format(
+                self.seconds))
+
+    def _expire(self):
+        self.expired = True
+        self._kill_all()
+
+    def _kill_all(self):
+        with self._lock:
+            for pgid in self._process_groups:
+                _kill_process_group(pgid)
+            self._process_groups.clear()
+
+
+# The active supervisor of each thread
+_state = threading.local()
+
+
+def _get_current_supervisor() -> ProcessSupervisor:
+    return getattr(_state, 'supervisor', None)
+
+
+def get_supervisor_deadline() -> float:
+    """Get the deadline (a timestamp) of the active ProcessSupervisor of the
+    thread, or None if no supervisor is active."""
+    supervisor = _get_current_supervisor()
+    if supervisor is None:
+        return None
+    return supervisor.deadline
+
+
+def _kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, SIGKILL)
+    except ProcessLookupError:
+        # all processes of the group have terminated already
+        pass
+
+
+def supervised_popen(args: List[str], **kwargs) -> subprocess.Popen:
+    """
+    Start a subprocess in a new process group supervised by the active
+    ProcessSupervisor of the thread.
+    """
+    process = subprocess.Popen(args, start_new_session=True, **kwargs)
+    process.supervisor = _get_current_supervisor()
+    if process.supervisor is not None:
+        process.supervisor.register(process.pid)
+    return process
+
+
+def _wait_supervised(process: subprocess.Popen) -> int:
+    """Wait for a process started by supervised_popen and unregister its
+    process group before reaping it."""
+    if process.supervisor is not None and hasattr(os, 'waitid'):
+        try:
+            # wait without reaping, so the id can not be reused yet
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        except ChildProcessError:
+            pass
+        process.supervisor.unregister(process.pid)
+    returncode = process.wait()
+    if process.supervisor is not None:
+        # the id may have been reused already
+        process.supervisor.unregister(process.pid, kill=False)
+    return returncode
+
+
+def supervised_call(args: List[str], **kwargs) -> int:
+    """Like subprocess.call, but supervised."""
+    return _wait_supervised(supervised_popen(args, **kwargs))
+
+
+def supervised_check_output(args: List[str], **kwargs) -> bytes:
+    """Like subprocess.check_output, but supervised."""
+    process = supervised_popen(args, stdout=subprocess.PIPE, **kwargs)
+    with process.stdout:
+        output = process.stdout.read()
+    _wait_supervised(process)
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, args, output=output)
+    return output
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Crawl daemon keeping a pool of running OpenWPM browsers.
+
+Like openwpm_wrapper.py, this needs to run in the virtualenv of OpenWPM.
+
+Scans are requested over a unix socket by sending a json line
+{"url": ..., "scan_dir": ...}. Once the visit is finished, the same files
+openwpm_wrapper.py creates (openwpm.log, crawl-data.sqlite3,
+screenshots/screenshot.png and sources/source.html) have been written to
+scan_dir and the daemon answers with a json line {"success": ...}.
+
+Each browser has its own task manager. The browser profile is reset after
+every visit, and the data of the visit is moved from the database of the
+task manager to the database in scan_dir. Likewise, the messages the task
+manager, browser and data aggregator log during the visit are appended to
+openwpm.log in scan_dir, after the messages of the daemon itself.
+
+Syntax: ./openwpm_daemon.py socket_path work_dir [num_browsers]
+"""
+
+import json
+import logging
+import os
+import select
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from Queue import Empty, Queue
+from SocketServer import StreamRequestHandler, ThreadingMixIn, \
+    UnixStreamServer
+
+from vendor.OpenWPM.automation import TaskManager
+from vendor.OpenWPM.automation.SocketInterface import clientsocket
+
+from openwpm_wrapper import build_command_sequence, handle_exception, \
+    load_params, normalize_site
+
+
+logger = logging.getLogger(__name__)
+
+
+# The seconds to wait until the data of a visit has been written to the
+# database by the data aggregator.
+AGGREGATOR_TIMEOUT = 60
+
+# The seconds a scan waits for a free browser.
+BROWSER_WAIT_TIMEOUT = 600
+
+# The files created by OpenWPM in the data directory for each visit.
+VISIT_FILES = [
+    'screenshots/screenshot.png',
+    'sources/source.html',
+]
+
+
+def mark_visit_finished(table_name, original_url, marker, **kwargs):
+    """Store a marker after all other data of the visit."""
+    manager_params = kwargs['manager_params']
+
+    sock = clientsocket()
+    sock.connect(*manager_params['aggregator_address'])
+
+    # table_name is hardcoded, see determine_final_url in openwpm_wrapper.py
+    query = ("CREATE TABLE IF NOT EXISTS %s ("
+             "original_url TEXT, marker TEXT);" % table_name)
+    sock.send((query, ()))
+
+    query = ("INSERT INTO %s (original_url, marker) "
+             "VALUES (?, ?)" % table_name)
+    sock.send((query, (original_url, marker)))
+    sock.close()
+
+
+class _ThreadFilter(logging.Filter):
+    """Only pass records of the current thread."""
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.thread = threading.current_thread().ident
+
+    def filter(self, record):
+        return record.thread == self.thread
+
+
+class Browser(object):
+    """A browser of the pool with its own task manager."""
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.manager = None
+        self.manager_params = None
+
+    def start(self):
+        if os.path.isdir(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        os.makedirs(self.work_dir)
+
+        self.manager_params, browser_params = load_params(1, self.work_dir)
+        self.manager = TaskManager.TaskManager(
+            self.manager_params, browser_params)
+
+    def close(self):
+        if self.manager is None:
+            return
+        try:
+            self.manager.close()
+        except Exception:
+            logger.exception("Exception while closing task manager.")
+        self.manager = None
+
+    def scan(self, site, scan_dir, abandoned):
+        """
+        Visit site and write the results to scan_dir.
+
+        The scan is stopped once abandoned() returns True, e.g. because the
+        client has disconnected and removed scan_dir.
+        """
+        site = normalize_site(site)
+        export_file = os.path.join(scan_dir, 'crawl-data.sqlite3')
+
+        # We will try several times, but only the first time we will attempt to save a screenshot
+        max_tries = 2
+        try:
+            for current_try in range(max_tries):
+                if abandoned():
+                    logger.info("Scan has been abandoned by the client.")
+                    return False
+                if self.manager is None:
+                    self.start()
+                for name in VISIT_FILES:
+                    path = os.path.join(self.work_dir, name)
+                    if os.path.isfile(path):
+                        os.remove(path)
+
+                marker = uuid.uuid4().hex
+                log_offset = self._log_size()
+                try:
+                    command_sequence = build_command_sequence(
+                        site, save_screenshot=current_try == 0, reset=True)
+                    command_sequence.run_custom_function(
+                        mark_visit_finished, ('visit_markers', site, marker))
+                    self.manager.execute_command_sequence(
+                        command_sequence, index='**')
+                    self._wait_for_marker(marker)
+                except Exception:
+                    logger.exception("Exception during retrieval with OpenWPM. Continuing.")
+                    self._copy_log(log_offset, scan_dir)
+                    # start with a new task manager
+                    self.close()
+                else:
+                    self._copy_log(log_offset, scan_dir)
+
+                if abandoned():
+                    logger.info("Scan has been abandoned by the client.")
+                    return False
+                if self._export_visit(site, export_file):
+                    self._move_visit_files(scan_dir)
+                    return True
+
+                if current_try + 1 < max_tries:
+                    logger.info("Trying again because scan failed...\n")
+            return False
+        finally:
+            # the database is expected in scan_dir in any case
+            if os.path.isdir(scan_dir):
+                open(export_file, 'ab').close()
+
+    def _log_path(self):
+        return os.path.join(
+            self.manager_params['log_directory'],
+            self.manager_params.get('log_file', 'openwpm.log'))
+
+    def _log_size(self):
+        try:
+            return os.path.getsize(self._log_path())
+        except OSError:
+            return 0
+
+    def _copy_log(self, offset, scan_dir):
+        """
+        Append the messages OpenWPM has logged since offset to the log of
+        the visit.
+
+        The task manager, the browser and the data aggregator log to a file
+        of the task manager. As the browser only performs one visit at a
+        time, the messages written since the visit started belong to it.
+        """
+        if not os.path.isdir(scan_dir):
+            return
+        try:
+            with open(self._log_path(), 'rb') as log:
+                log.seek(offset)
+                data = log.read()
+        except IOError:
+            return
+        with open(os.path.join(scan_dir, 'openwpm.log'), 'ab') as f:
+            f.write(data)
+
+    def _database(self):
+        return sqlite3.connect(os.path.join(
+            self.manager_params['data_directory'],
+            self.manager_params['database_name']), timeout=AGGREGATOR_TIMEOUT)
+
+    def _wait_for_marker(self, marker):
+        deadline = time.time() + AGGREGATOR_TIMEOUT
+        conn = self._database()
+        try:
+            while time.time() < deadline:
+                try:
+                    if conn.execute(
+                            "SELECT 1 FROM visit_markers WHERE marker = ?",
+                            (marker,)).fetchone():
+                        return
+                except sqlite3.OperationalError:
+                    # the table has not been created yet
+                    pass
+                time.sleep(0.5)
+            logger.info("Data of the visit has not been written in time.")
+        finally:
+            conn.close()
+
+    def _export_visit(self, site, export_file):
+        """
+        Move all data of the latest visit of site to export_file.
+
+        Return whether the scan succeeded, i.e. whether the final url has
+        been stored (see check_scan_succeeded in openwpm_wrapper.py).
+        """
+        if self.manager_params is None:
+            return False
+        if os.path.isfile(export_file):
+            os.remove(export_file)
+
+        conn = self._database()
+        try:
+            conn.execute("ATTACH DATABASE ? AS export", (export_file,))
+            row = conn.execute(
+                "SELECT visit_id, crawl_id FROM site_visits "
+                "WHERE site_url = ? ORDER BY visit_id DESC LIMIT 1",
+                (site,)).fetchone()
+            if row is None:
+                return False
+            visit_id, crawl_id = row
+
+            try:
+                task_id, = conn.execute(
+                    "SELECT task_id FROM crawl WHERE crawl_id = ?",
+                    (crawl_id,)).fetchone()
+            except (sqlite3.OperationalError, TypeError):
+                task_id = None
+
+            tables = [name for name, in conn.execute(
+                "SELECT name FROM main.sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE 'sqlite_%'")]
+            for table in tables:
+                columns = [info[1] for info in conn.execute(
+                    'PRAGMA main.table_info("%s")' % table)]
+                # The rows of the crawl and the task of the task manager are
+                # needed by the following visits and are not deleted; all
+                # other exported rows belong to this visit.
+                keep = table in ('crawl', 'task')
+                if 'visit_id' in columns:
+                    condition, args = 'visit_id = ?', (visit_id,)
+                elif 'original_url' in columns:
+                    condition, args = 'original_url = ?', (site,)
+                elif 'crawl_id' in columns:
+                    # e.g. CrawlHistory, whose rows of earlier visits have
+                    # been deleted by their export
+                    condition, args = 'crawl_id = ?', (crawl_id,)
+                elif 'task_id' in columns and task_id is not None:
+                    condition, args = 'task_id = ?', (task_id,)
+                else:
+                    # not related to any visit
+                    continue
+
+                # table names are taken from the database itself
+                conn.execute(
+                    'CREATE TABLE export."%s" AS SELECT * FROM main."%s" '
+                    'WHERE 0' % (table, table))
+                conn.execute(
+                    'INSERT INTO export."%s" SELECT * FROM main."%s" '
+                    'WHERE %s' % (table, table, condition), args)
+                if not keep:
+                    conn.execute(
+                        'DELETE FROM main."%s" WHERE %s' % (table, condition),
+                        args)
+            conn.commit()
+
+            try:
+                return conn.execute(
+                    "SELECT 1 FROM export.final_urls").fetchone() is not None
+            except sqlite3.OperationalError:
+                # the table does not exist at all
+                return False
+        finally:
+            conn.close()
+
+    def _move_visit_files(self, scan_dir):
+        for name in VISIT_FILES:
+            path = os.path.join(self.work_dir, name)
+            if not os.path.isfile(path):
+                continue
+            target = os.path.join(scan_dir, name)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.move(path, target)
+
+
+class ScanHandler(StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        scan_dir = self.scan_dir = request['scan_dir']
+
+        # log messages of this scan are written to its scan dir
+        handler = logging.FileHandler(os.path.join(scan_dir, 'openwpm.log'))
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(funcName)s %(message)s'))
+        handler.addFilter(_ThreadFilter())
+        logging.getLogger().addHandler(handler)
+
+        try:
+            browser = self._get_browser()
+            if browser is None:
+                logger.info("No browser available.")
+                success = False
+            else:
+                try:
+                    success = browser.scan(
+                        request['url'], scan_dir, self._client_disconnected)
+                except Exception:
+                    logger.exception("Exception during scan.")
+                    success = False
+                finally:
+                    self.server.browsers.put(browser)
+        finally:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+
+        if not self._client_disconnected():
+            self.wfile.write(json.dumps({'success': success}) + '\n')
+
+    def _get_browser(self):
+        """Wait for a free browser as long as the client waits, but at most
+        BROWSER_WAIT_TIMEOUT seconds."""
+        deadline = time.time() + BROWSER_WAIT_TIMEOUT
+        while time.time() < deadline and not self._client_disconnected():
+            try:
+                return self.server.browsers.get(timeout=1)
+            except Empty:
+                pass
+        return None
+
+    def _client_disconnected(self):
+        """Check whether the client has closed the connection, e.g. after a
+        timeout, or has removed the scan dir."""
+        if not os.path.isdir(self.scan_dir):
+            return True
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            # the client sends nothing after its request
+            return self.connection.recv(1, socket.MSG_PEEK) == b''
+        except socket.error:
+            return True
+
+
+class ScanServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, work_dir, num_browsers):
+        self.browsers = Queue()
+        for i in range(num_browsers):
+            browser = Browser(os.path.join(work_dir, str(i)))
+            browser.start()
+            self.browsers.put(browser)
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        UnixStreamServer.__init__(self, socket_path, ScanHandler)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        while not self.browsers.empty():
+            self.browsers.get().close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(funcName)s %(message)s')
+    sys.excepthook = handle_exception
+
+    server = ScanServer(sys.argv[1], sys.argv[2],
+                        int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
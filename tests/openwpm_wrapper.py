@@ -24,11 +24,8 @@ from vendor.OpenWPM.automation.SocketInterface import clientsocket
 # TODO: Clean up this script
 
 
-SCAN_DIR = sys.argv[2]
-
 # Logging
 
-logging.basicConfig(level=logging.INFO, filename=os.path.join(SCAN_DIR, "openwpm.log"), format='%(asctime)s %(funcName)s %(message)s')
 logger = logging.getLogger(__name__)
 
 def handle_exception(exc_type, exc_value, exc_traceback):
@@ -38,8 +35,6 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 
     logger.error("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
 
-sys.excepthook = handle_exception
-
 
 
 # Scan with only one browser
@@ -127,29 +122,77 @@ def get_browser_log(table_name, original_url, **kwargs):
     sock.close()
 
 
-def scan_site(site):
+def load_params(num_browsers, data_directory):
+    """Load the parameters of the task manager and the browsers."""
+    # Retrieve default parameters
+    manager_params, browser_params = TaskManager.load_default_params(num_browsers)
+
+    # Personalize browser parameters
+    for i in range(num_browsers):
+        browser_params[i]['disable_flash'] = False
+        browser_params[i]['headless'] = True
+        browser_params[i]['bot_mitigation'] = True # needed to ensure we look more "normal"
+        browser_params[i]['http_instrument'] = True
+        browser_params[i]['js_instrument'] = True
+
+    # Personalize manager parameters
+    manager_params['data_directory'] = data_directory
+    manager_params['log_directory'] = data_directory
+    manager_params['database_name'] = 'crawl-data.sqlite3'
+
+    return manager_params, browser_params
+
+
+def normalize_site(site):
+    """Normalize the url of the site as it is visited and stored."""
+    # Ensure URL is valid
+    if not(site.startswith("http")):
+        site = "http://" + str(site)
+
+    # append trailing / if url does not contain a path part
+    if re.search(r"^(https?:\/\/)?[^\/]*$", site, re.IGNORECASE):
+        site = site + "/"
+
+    return site
+
+
+def build_command_sequence(site, save_screenshot, reset=False):
+    """Assemble the command sequence visiting the (normalized) site."""
+    # Assemble command sequence for browser
+    command_sequence = CommandSequence.CommandSequence(site, reset=reset)
+    command_sequence.get(sleep=10, timeout=180) # 10 sec sleep so everything settles down
+
+    # save a screenshot
+    # unfortunately in selenium 2 (which we have to use because
+    # selenium 3's webdriver does not support get_browser_log in
+    # Firefox (which we have to use because openwpm does not support
+    # Chrome) screenshots will always take the whole page. This may
+    # take very long. Sadly, sometimes saving fails altogether and the
+    #  browser hangs. This will cause the scan to fail completely.
+    # 
+    # We can detect the failure by checking whether final_urls
+    # table exists after the scan. If it does not exist we could
+    # start another attempt (right in this function), that time
+    # without screen saving.
+    if save_screenshot:
+        command_sequence.save_screenshot('screenshot', 60)
+
+    command_sequence.dump_page_source('source', 30)
+    command_sequence.run_custom_function(determine_final_url, ('final_urls', site)) # needed to determine whether site redirects to https
+    command_sequence.run_custom_function(get_browser_log, ('browser_logs', site)) # needed to determine if mixed content was blocked
+    command_sequence.dump_profile_cookies(30) # this also closes the currently open tab
+    command_sequence.dump_flash_cookies(30)
+    return command_sequence
+
+
+def scan_site(site, scan_dir):
     # We will try several times, but only the first time we will attempt to save a screenshot
 
     max_tries = 2
     save_screenshot = True
     for current_try in range(2):
         try:
-
-            # Retrieve default parameters
-            manager_params, browser_params = TaskManager.load_default_params(NUM_BROWSERS)
-
-            # Personalize browser parameters
-            for i in range(NUM_BROWSERS):
-                browser_params[i]['disable_flash'] = False
-                browser_params[i]['headless'] = True
-                browser_params[i]['bot_mitigation'] = True # needed to ensure we look more "normal"
-                browser_params[i]['http_instrument'] = True
-                browser_params[i]['js_instrument'] = True
-
-            # Personalize manager parameters
-            manager_params['data_directory'] = SCAN_DIR
-            manager_params['log_directory'] = SCAN_DIR
-            manager_params['database_name'] = 'crawl-data.sqlite3'
+            manager_params, browser_params = load_params(NUM_BROWSERS, scan_dir)
             manager = TaskManager.TaskManager(manager_params, browser_params)
 
             # TODO Commented out status reporting
@@ -157,38 +200,9 @@ def scan_site(site):
             # db.ScanGroup.update({'_id': ObjectId(scangroup_id)}, {'$set': {'progress': "Retrieving URL %i/%i" % (i, num_url_list)}})
             # db.ScanGroup.update({'_id': ObjectId(scangroup_id)}, {'$set':{'progress_timestamp': datetime.now().isoformat()}}, upsert=False)
 
-            # Ensure URL is valid
-            if not(site.startswith("http")):
-                site = "http://" + str(site)
-
-            # append trailing / if url does not contain a path part
-            if re.search(r"^(https?:\/\/)?[^\/]*$", site, re.IGNORECASE):
-                site = site + "/"
-
-            # Assemble command sequence for browser
-            command_sequence = CommandSequence.CommandSequence(site)
-            command_sequence.get(sleep=10, timeout=180) # 10 sec sleep so everything settles down
-
-            # save a screenshot
-            # unfortunately in selenium 2 (which we have to use because
-            # selenium 3's webdriver does not support get_browser_log in
-            # Firefox (which we have to use because openwpm does not support
-            # Chrome) screenshots will always take the whole page. This may
-            # take very long. Sadly, sometimes saving fails altogether and the
-            #  browser hangs. This will cause the scan to fail completely.
-            # 
-            # We can detect the failure by checking whether final_urls
-            # table exists after the scan. If it does not exist we could
-            # start another attempt (right in this function), that time
-            # without screen saving.
-            if save_screenshot:
-                command_sequence.save_screenshot('screenshot', 60)
-
-            command_sequence.dump_page_source('source', 30)
-            command_sequence.run_custom_function(determine_final_url, ('final_urls', site)) # needed to determine whether site redirects to https
-            command_sequence.run_custom_function(get_browser_log, ('browser_logs', site)) # needed to determine if mixed content was blocked
-            command_sequence.dump_profile_cookies(30) # this also closes the currently open tab
-            command_sequence.dump_flash_cookies(30)
+            site = normalize_site(site)
+            command_sequence = build_command_sequence(site, save_screenshot)
+
             # Execute command sequence
             manager.execute_command_sequence(command_sequence, index='**') # ** for synchronized Browsers
 
@@ -208,4 +222,7 @@ def scan_site(site):
 
 
 if __name__ == '__main__':
-    scan_site(sys.argv[1])
+    logging.basicConfig(level=logging.INFO, filename=os.path.join(sys.argv[2], "openwpm.log"), format='%(asctime)s %(funcName)s %(message)s')
+    sys.excepthook = handle_exception
+
+    scan_site(sys.argv[1], sys.argv[2])